@@ -3,18 +3,23 @@ MD2WE - Markdown转微信公众号HTML工具
 支持丰富的主题和API调用
 """
 
-from flask import Flask, render_template, request, jsonify, abort, url_for, send_from_directory
+from flask import Flask, Response, render_template, request, jsonify, abort, url_for, send_from_directory, redirect
 from flask_cors import CORS
 import markdown
 from markdown.extensions.tables import TableExtension
 from markdown.extensions.fenced_code import FencedCodeExtension
 from markdown.extensions.toc import TocExtension
 from pygments import highlight
-from pygments.lexers import get_lexer_by_name, guess_lexer
+from pygments.lexers import get_all_lexers, get_lexer_by_name, guess_lexer
 from pygments.formatters import HtmlFormatter
 from pygments.styles import get_style_by_name
+from pygments.util import ClassNotFound
 import re
 import json
+import hashlib
+import gzip
+import zlib
+import sys
 import logging
 import io
 import base64
@@ -28,9 +33,16 @@ import threading
 import tempfile
 import uuid
 import copy
+import functools
+import multiprocessing
 import time
 import socket
+import sqlite3
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from types import MappingProxyType
 from datetime import datetime, timezone
 from http.client import RemoteDisconnected
 from urllib.error import HTTPError, URLError
@@ -79,6 +91,7 @@ except ImportError:
 app = Flask(__name__)
 CORS(app)
 DEFAULT_SHARE_STORAGE_DIR = Path(app.root_path) / "data" / "shares"
+SHARE_DB_FILENAME = "shares.sqlite3"
 AI_CRYPTO_KEY_PATH = Path(app.instance_path) / "ai_config_private_key.pem"
 AI_CRYPTO_FALLBACK_KEY_PATH = Path(tempfile.gettempdir()) / "md2we" / "ai_config_private_key.pem"
 ILLUSTRATION_JOB_STORAGE_DIR = Path(app.instance_path) / "illustration_jobs"
@@ -93,6 +106,8 @@ SITE_DESCRIPTION = os.getenv(
 ).strip()
 GOOGLE_ANALYTICS_MEASUREMENT_ID = (os.getenv("GA_MEASUREMENT_ID", "") or "").strip()
 _ACTIVE_SHARE_STORAGE_DIR = None
+_SHARE_REPOSITORY = None
+_SHARE_REPOSITORY_LOCK = threading.Lock()
 UPLOAD_IMAGE_MAX_BYTES = 10 * 1024 * 1024
 UPLOAD_IMAGE_ALLOWED_MIME_TYPES = {
     "image/jpeg",
@@ -106,6 +121,80 @@ AI_REQUEST_MAX_ATTEMPTS = 3
 AI_REQUEST_RETRY_BACKOFF_SECONDS = 2
 
 
+def read_int_env(name, default):
+    """读取整数环境变量，非法值回退默认值。"""
+    raw_value = (os.getenv(name, "") or "").strip()
+    if not raw_value:
+        return default
+    try:
+        return int(raw_value)
+    except ValueError:
+        return default
+
+
+RENDER_CACHE_MAX_ENTRIES = read_int_env("RENDER_CACHE_MAX_ENTRIES", 256)
+RENDER_CACHE_MAX_BYTES = read_int_env("RENDER_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+BLOCK_RENDER_CACHE_MAX_ENTRIES = read_int_env("BLOCK_RENDER_CACHE_MAX_ENTRIES", 4096)
+BLOCK_RENDER_CACHE_MAX_BYTES = read_int_env("BLOCK_RENDER_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+HIGHLIGHT_CACHE_MAX_ENTRIES = read_int_env("HIGHLIGHT_CACHE_MAX_ENTRIES", 2048)
+HIGHLIGHT_CACHE_MAX_BYTES = read_int_env("HIGHLIGHT_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+CODE_LANGUAGE_DETECTION_MAX_CHARS = read_int_env("CODE_LANGUAGE_DETECTION_MAX_CHARS", 2000)
+LANGUAGE_DETECTION_CACHE_MAX_ENTRIES = read_int_env("LANGUAGE_DETECTION_CACHE_MAX_ENTRIES", 2048)
+BATCH_RENDER_MAX_JOBS = read_int_env("BATCH_RENDER_MAX_JOBS", 64)
+BATCH_RENDER_WORKERS = read_int_env("BATCH_RENDER_WORKERS", os.cpu_count() or 1)
+FORMULA_CACHE_DIR = Path(
+    (os.getenv("FORMULA_CACHE_DIR") or "").strip() or Path(app.instance_path) / "formula_cache"
+).expanduser()
+FORMULA_CACHE_MAX_BYTES = read_int_env("FORMULA_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+FORMULA_SPEC_DIR = Path(
+    (os.getenv("FORMULA_SPEC_DIR") or "").strip() or Path(app.instance_path) / "formula_specs"
+).expanduser()
+FORMULA_SPEC_CACHE_MAX_BYTES = read_int_env("FORMULA_SPEC_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+FORMULA_RENDER_DPI = 150
+FORMULA_RENDER_CONCURRENCY = read_int_env("FORMULA_RENDER_CONCURRENCY", 8)
+MATH_RENDER_ENGINES = ("local", "remote", "offline")
+MATH_RENDER_ENGINE = (os.getenv("MATH_RENDER_ENGINE") or "local").strip().lower()
+if MATH_RENDER_ENGINE not in MATH_RENDER_ENGINES:
+    MATH_RENDER_ENGINE = "local"
+MATH_RENDER_WORKERS = read_int_env("MATH_RENDER_WORKERS", 2)
+MATH_RENDER_TIMEOUT_SECONDS = 10
+MATHTEXT_FONT_SIZE = 16
+# 公式图片格式：svg 任意缩放都清晰、gzip 后体积更小，适合浏览器预览；微信公众号不支持 svg，发布必须使用 png
+MATH_FORMATS = ("png", "svg")
+# 公式图片引用方式：inline 内联为 data URL，HTML 自包含；hosted 按内容哈希保存到分享图片目录，以 URL 引用；
+# deferred 只输出带公式哈希的占位图片，由前端在正文显示后再从 /api/math 加载，用于编辑器实时预览
+MATH_IMAGE_MODES = ("inline", "hosted", "deferred")
+FORMULA_IMAGE_MAX_AGE = 365 * 24 * 3600
+# 延迟加载的公式渲染失败时，浏览器短时间内不再重复请求
+FORMULA_FAILURE_MAX_AGE = 60
+REMOTE_MATH_TIMEOUT_SECONDS = 10
+WECHAT_IMAGE_URL_CACHE_MAX_BYTES = read_int_env("WECHAT_IMAGE_URL_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+REMOTE_MATH_FAILURE_THRESHOLD = read_int_env("REMOTE_MATH_FAILURE_THRESHOLD", 3)
+REMOTE_MATH_PROBE_INTERVAL_SECONDS = read_int_env("REMOTE_MATH_PROBE_INTERVAL_SECONDS", 30)
+# 单个 sitemap 文件最多 50000 个地址（sitemaps.org 协议上限），超出后拆分并输出 sitemap 索引
+SITEMAP_MAX_URLS = min(max(1, read_int_env("SITEMAP_MAX_URLS", 50000)), 50000)
+SITEMAP_MAX_AGE = 300
+SHARE_PAGE_CACHE_MAX_ENTRIES = read_int_env("SHARE_PAGE_CACHE_MAX_ENTRIES", 512)
+SHARE_PAGE_CACHE_MAX_BYTES = read_int_env("SHARE_PAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+SHARE_PAGE_DISK_CACHE_MAX_BYTES = read_int_env("SHARE_PAGE_DISK_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+# 分享内容创建后不再变化，浏览器和 CDN 可缓存一段时间，过期后用 ETag 重新验证
+SHARE_PAGE_MAX_AGE = 300
+SHARE_PAGE_TEMPLATES = ("share.html", "_analytics.html")
+# 分享页预先压缩时使用最高压缩级别，只在写入缓存时压缩一次
+SHARE_PAGE_GZIP_LEVEL = 9
+# 大于该字节数的 JSON 响应在客户端支持时即时 gzip 压缩，设为 0 关闭
+RESPONSE_GZIP_MIN_BYTES = read_int_env("RESPONSE_GZIP_MIN_BYTES", 1024)
+RESPONSE_GZIP_LEVEL = 6
+# 配置后每个分享页额外导出为静态文件（share/<id>.html、.html.gz 及引用的 share/images/*），由 nginx 直接提供
+SHARE_STATIC_EXPORT_DIR = (os.getenv("SHARE_STATIC_EXPORT_DIR") or "").strip()
+QR_SVG_CACHE_MAX_ENTRIES = read_int_env("QR_SVG_CACHE_MAX_ENTRIES", 1024)
+# 二维码 SVG 格式：path 为 qrcode 库自带的输出，每个模块一段子路径；compact 把同一行相邻模块合并为一个矩形，体积不到前者的一半
+QR_SVG_FORMATS = ("path", "compact")
+QR_SVG_FORMAT = (os.getenv("QR_SVG_FORMAT") or "path").strip().lower()
+if QR_SVG_FORMAT not in QR_SVG_FORMATS:
+    QR_SVG_FORMAT = "path"
+
+
 def configure_app_logging():
     """将应用日志稳定输出到控制台。"""
     formatter = logging.Formatter(
@@ -373,6 +462,37 @@ def log_request_finished(response):
     return response
 
 
+def client_accepts_gzip():
+    """判断当前请求是否接受 gzip 编码的响应。"""
+    return request.accept_encodings.quality("gzip") > 0
+
+
+@app.after_request
+def compress_json_response(response):
+    """客户端支持时即时 gzip 压缩较大的 JSON 响应；流式响应和已编码的响应保持原样。"""
+    if (
+        RESPONSE_GZIP_MIN_BYTES <= 0
+        or response.mimetype != "application/json"
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or not 200 <= response.status_code < 300
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    if not client_accepts_gzip():
+        return response
+
+    data = response.get_data()
+    if len(data) < RESPONSE_GZIP_MIN_BYTES:
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=RESPONSE_GZIP_LEVEL))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
 def iter_ai_crypto_key_paths():
     """返回 AI 私钥候选路径，优先使用显式配置。"""
     explicit_path = (os.getenv("AI_CONFIG_PRIVATE_KEY_PATH") or "").strip()
@@ -456,6 +576,9 @@ def iter_share_image_dirs():
         yield image_dir
 
 
+SHARE_IMAGE_URL_PREFIX = "/share/images/"
+
+
 def get_active_share_image_dir():
     """返回当前用于写入的分享图片目录。"""
     image_dir = get_active_share_storage_dir() / "images"
@@ -485,6 +608,37 @@ def save_generated_image_bytes(image_bytes, mime_type):
     return filename
 
 
+def save_formula_image_bytes(image_bytes, image_format):
+    """按内容哈希保存公式图片并返回文件名，相同图片只写入一次。"""
+    image_dir = get_active_share_image_dir()
+    filename = f"formula-{hashlib.sha256(image_bytes).hexdigest()[:32]}.{image_format}"
+    image_path = image_dir / filename
+    if not image_path.exists():
+        with tempfile.NamedTemporaryFile(dir=str(image_dir), suffix=".tmp", delete=False) as fp:
+            fp.write(image_bytes)
+            temp_path = Path(fp.name)
+        os.replace(temp_path, image_path)
+    return filename
+
+
+def build_share_image_path(filename):
+    """返回分享图片的站内路径；不依赖请求上下文，可在渲染线程和子进程中调用。"""
+    return f"{SHARE_IMAGE_URL_PREFIX}{urllib.parse.quote(filename)}"
+
+
+def find_share_image_path(filename):
+    """在分享图片目录中查找文件，文件名不合法或不存在时返回 None。"""
+    safe_name = os.path.basename(filename or "")
+    if safe_name != filename or not safe_name:
+        return None
+
+    for image_dir in iter_share_image_dirs():
+        image_path = image_dir / safe_name
+        if image_path.exists() and image_path.is_file():
+            return image_path
+    return None
+
+
 def sanitize_markdown_image_alt(raw_name):
     """根据文件名生成适合 Markdown 的 alt 文本。"""
     alt_text = re.sub(r"[-_]+", " ", Path(raw_name or "").stem).strip()
@@ -1548,32 +1702,162 @@ def build_share_structured_data(title, description, canonical_url, published_at,
     return structured_data
 
 
-def iter_share_sitemap_entries():
-    """遍历 sitemap 需要输出的分享页。"""
-    entries = []
-    seen_share_ids = set()
+def render_sitemap_url(loc, lastmod="", tag="url"):
+    """渲染 sitemap 中的一个 <url> 或 <sitemap> 条目。"""
+    lines = [f"  <{tag}>", f"    <loc>{html_lib.escape(loc)}</loc>"]
+    if lastmod:
+        lines.append(f"    <lastmod>{html_lib.escape(lastmod)}</lastmod>")
+    lines.append(f"  </{tag}>")
+    return "\n".join(lines)
 
-    for share_dir in iter_share_storage_dirs():
-        if not share_dir.exists():
-            continue
 
-        for share_path in sorted(share_dir.glob("*.json")):
-            try:
-                payload = json.loads(share_path.read_text("utf-8"))
-            except (OSError, ValueError):
-                continue
+def render_sitemap_document(fragments, root_tag="urlset"):
+    """把条目拼成完整的 sitemap 文档，返回 (XML, ETag)。"""
+    xml = "\n".join([
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        f'<{root_tag} xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+        *fragments,
+        f"</{root_tag}>"
+    ]) + "\n"
+    return xml, hashlib.sha256(xml.encode("utf-8")).hexdigest()[:32]
 
-            share_id = (payload.get("id") or share_path.stem or "").strip()
-            if not share_id or share_id in seen_share_ids:
-                continue
 
-            seen_share_ids.add(share_id)
-            entries.append({
-                "loc": build_public_url("share_article", share_id=share_id),
-                "lastmod": normalize_iso_timestamp(payload.get("created_at"))
-            })
+class SitemapCache:
+    """进程内缓存渲染好的 sitemap，按分享清单版本号失效。
+
+    新分享只会追加在末尾，因此清单变化时只读取新写入的分享并重新渲染最后一页；
+    超过 max_urls 个地址时拆分为多页，由 sitemap 索引引用。
+    """
+
+    def __init__(self, name, max_urls):
+        self.name = name
+        self.max_urls = max(1, int(max_urls))
+        self._lock = threading.Lock()
+        self._state = None
+        self.full_rebuilds = 0
+        self.incremental_updates = 0
+
+    def snapshot(self, repository, base_url):
+        """返回与当前清单版本一致的 sitemap 状态。"""
+        manifest = repository.get_manifest()
+        with self._lock:
+            state = self._state
+            if state is None or state["base_url"] != base_url:
+                state = self._rebuild(repository, base_url, manifest)
+            elif state["revision"] != manifest["revision"]:
+                state = self._update(repository, state, manifest) or self._rebuild(repository, base_url, manifest)
+            self._state = state
+            return state
+
+    def _share_fragment(self, metadata, share_url_prefix):
+        # 分享 ID 只含十六进制字符，直接拼接前缀，避免对每条分享调用一次 url_for
+        return render_sitemap_url(
+            share_url_prefix + metadata["id"],
+            normalize_iso_timestamp(metadata["created_at"])
+        )
+
+    def _rebuild(self, repository, base_url, manifest):
+        self.full_rebuilds += 1
+        state = {
+            "base_url": base_url,
+            "revision": manifest["revision"],
+            "updated_at": manifest["updated_at"],
+            "count": 0,
+            "max_rowid": 0,
+            "last_key": ("", ""),
+            "pages": [],
+            "tail": [render_sitemap_url(build_public_url("index", public_base_url=base_url))],
+            "tail_lastmod": "",
+            "share_url_prefix": build_public_url("share_article", public_base_url=base_url, share_id="x")[:-1]
+        }
+        self._append(state, repository.iter_metadata())
+        return state
+
+    def _update(self, repository, state, manifest):
+        """只读取新写入的分享；如果不是单纯的追加（如导入了更早的旧分享），返回 None 由调用方全量重建。"""
+        new_rows = list(repository.iter_metadata(after_rowid=state["max_rowid"]))
+        if state["count"] + len(new_rows) != repository.count():
+            return None
+        if new_rows and (new_rows[0]["created_at"], new_rows[0]["id"]) < state["last_key"]:
+            return None
+
+        self.incremental_updates += 1
+        state = dict(state, pages=list(state["pages"]), tail=list(state["tail"]))
+        state["revision"] = manifest["revision"]
+        state["updated_at"] = manifest["updated_at"]
+        # 最后一页会重新渲染
+        state["pages"].pop()
+        self._append(state, new_rows)
+        return state
+
+    def _append(self, state, rows):
+        pages = state["pages"]
+        tail = state["tail"]
+        for metadata in rows:
+            if len(tail) >= self.max_urls:
+                pages.append((*render_sitemap_document(tail), state["tail_lastmod"]))
+                tail = []
+            tail.append(self._share_fragment(metadata, state["share_url_prefix"]))
+            state["count"] += 1
+            state["max_rowid"] = max(state["max_rowid"], metadata["rowid"])
+            state["last_key"] = (metadata["created_at"], metadata["id"])
+            # 分享按创建时间排序，每页最后一条就是这一页的最后修改时间
+            state["tail_lastmod"] = normalize_iso_timestamp(metadata["created_at"])
+        pages.append((*render_sitemap_document(tail), state["tail_lastmod"]))
+        state["tail"] = tail
+
+        if len(pages) > 1:
+            state["index"] = render_sitemap_document(
+                [
+                    render_sitemap_url(
+                        build_public_url("sitemap_page", public_base_url=state["base_url"], page=number),
+                        lastmod,
+                        tag="sitemap"
+                    )
+                    for number, (_, _, lastmod) in enumerate(pages, start=1)
+                ],
+                root_tag="sitemapindex"
+            )
+        else:
+            state["index"] = None
+
+    def stats(self):
+        with self._lock:
+            state = self._state or {}
+            return {
+                "revision": state.get("revision", 0),
+                "urls": state.get("count", 0) + 1 if state else 0,
+                "pages": len(state.get("pages", [])),
+                "full_rebuilds": self.full_rebuilds,
+                "incremental_updates": self.incremental_updates
+            }
+
+
+SITEMAP_CACHE = SitemapCache("sitemap", SITEMAP_MAX_URLS)
+
+
+def build_sitemap_response(xml, etag, updated_at):
+    """输出 sitemap 响应，支持 ETag / Last-Modified 条件请求。"""
+    response = app.response_class(xml, mimetype="application/xml")
+    response.set_etag(etag)
+    if updated_at:
+        try:
+            response.last_modified = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+    response.cache_control.public = True
+    response.cache_control.max_age = SITEMAP_MAX_AGE
+    return response.make_conditional(request)
 
-    return entries
+
+def get_sitemap_snapshot():
+    """返回当前站点地址对应的 sitemap 缓存；没有可用的分享仓库时返回 None。"""
+    try:
+        repository = get_share_repository()
+    except OSError as exc:
+        app.logger.warning("Share repository unavailable for sitemap: %s", exc)
+        return None
+    return SITEMAP_CACHE.snapshot(repository, get_public_base_url())
 
 
 def sanitize_ai_config(ai_config=None):
@@ -1605,6 +1889,18 @@ def has_ai_capability(ai_config=None, capability="any"):
     return bool(config["text"]["api_key"] or config["image"]["api_key"])
 
 
+RENDER_OPTION_FIELDS = ("theme", "code_theme", "font_size", "background", "math_format", "math_images")
+
+
+def find_invalid_render_option(options):
+    """返回第一个既不是字符串也不是 null 的渲染参数名，全部合法时返回 None。"""
+    for field in RENDER_OPTION_FIELDS:
+        value = options.get(field)
+        if value is not None and not isinstance(value, str):
+            return field
+    return None
+
+
 def normalize_render_options(theme="default", code_theme="github", font_size="medium", background="warm"):
     """校验并规范化渲染参数。"""
     return (
@@ -1652,22 +1948,15 @@ def ensure_share_storage_dir():
     get_active_share_storage_dir().mkdir(parents=True, exist_ok=True)
 
 
-def get_share_file_path(share_id):
-    """返回分享文件路径。"""
-    safe_id = re.sub(r"[^a-f0-9]", "", (share_id or "").lower())[:32]
-    if not safe_id:
-        return None
-    return get_active_share_storage_dir() / f"{safe_id}.json"
-
+def normalize_share_id(share_id):
+    """过滤分享 ID 中的非法字符，不合法时返回空字符串。"""
+    return re.sub(r"[^a-f0-9]", "", (share_id or "").lower())[:32]
 
-def load_share_payload(share_id):
-    """读取分享数据。"""
-    safe_id = re.sub(r"[^a-f0-9]", "", (share_id or "").lower())[:32]
-    if not safe_id:
-        return None
 
+def read_legacy_share_file(share_id):
+    """从旧版的 <id>.json 分享文件读取分享数据，不存在返回 None。"""
     for share_dir in iter_share_storage_dirs():
-        share_path = share_dir / f"{safe_id}.json"
+        share_path = share_dir / f"{share_id}.json"
         if not share_path.exists():
             continue
         with share_path.open("r", encoding="utf-8") as fp:
@@ -1676,6 +1965,241 @@ def load_share_payload(share_id):
     return None
 
 
+class ShareRepository:
+    """分享内容仓库：元数据（id、标题、创建时间、设置、大小）存放在带索引的 SQLite 表中，
+    其余小字段以 JSON 保存在 meta 列，Markdown 和 HTML 正文分别 zlib 压缩，只在需要时读取和解压。
+
+    首次使用时自动导入分享目录中旧版的 <id>.json 文件，原文件保留不动；每个线程使用独立的连接。
+    """
+
+    SCHEMA = (
+        """
+        CREATE TABLE IF NOT EXISTS shares (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL DEFAULT '',
+            excerpt TEXT NOT NULL DEFAULT '',
+            created_at TEXT NOT NULL DEFAULT '',
+            settings TEXT NOT NULL DEFAULT '{}',
+            markdown_bytes INTEGER NOT NULL DEFAULT 0,
+            html_bytes INTEGER NOT NULL DEFAULT 0,
+            meta TEXT NOT NULL DEFAULT '{}',
+            markdown BLOB,
+            html BLOB,
+            qr_svg BLOB
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS shares_created_at ON shares (created_at)",
+        # 清单版本：每次写入分享时在同一事务中递增，sitemap 等派生数据据此判断是否需要更新
+        "CREATE TABLE IF NOT EXISTS share_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+    COLUMNS = (
+        "id", "title", "excerpt", "created_at", "settings", "markdown_bytes", "html_bytes",
+        "meta", "markdown", "html", "qr_svg"
+    )
+    # 单独压缩保存、按需解压的大字段
+    BODY_FIELDS = ("markdown", "html", "qr_svg")
+
+    def __init__(self, db_path, legacy_dirs=()):
+        self.db_path = Path(db_path)
+        self.legacy_dirs = tuple(legacy_dirs)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.db_path), timeout=30)
+            # WAL 模式下读写互不阻塞，多个 gunicorn worker 可以同时读取
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def connection(self):
+        """返回当前线程的连接，进程内首次调用时建表并导入旧版 JSON 文件。"""
+        connection = self._connect()
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    with connection:
+                        for statement in self.SCHEMA:
+                            connection.execute(statement)
+                    self.migrate_json_dirs(connection)
+                    self._initialized = True
+        return connection
+
+    @classmethod
+    def encode_payload(cls, payload):
+        """把分享数据拆成 (元数据 JSON, 各正文字段压缩后的数据...)。"""
+        meta = {key: value for key, value in payload.items() if key not in cls.BODY_FIELDS}
+        return (
+            json.dumps(meta, ensure_ascii=False, separators=(",", ":")),
+            *(zlib.compress((payload.get(field) or "").encode("utf-8"), 9) for field in cls.BODY_FIELDS)
+        )
+
+    @classmethod
+    def build_row(cls, payload, share_id=None):
+        """把分享数据拆成元数据列、meta JSON 和压缩后的正文。"""
+        share_id = share_id or normalize_share_id(payload.get("id"))
+        return (
+            share_id,
+            payload.get("title") or "",
+            payload.get("excerpt") or "",
+            payload.get("created_at") or "",
+            json.dumps(payload.get("settings") or {}, ensure_ascii=False, sort_keys=True),
+            len((payload.get("markdown") or "").encode("utf-8")),
+            len((payload.get("html") or "").encode("utf-8")),
+            *cls.encode_payload(payload)
+        )
+
+    def _insert(self, connection, rows, replace=True):
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        placeholders = ", ".join("?" for _ in self.COLUMNS)
+        with connection:
+            cursor = connection.executemany(
+                f"{verb} INTO shares ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                rows
+            )
+            if cursor.rowcount > 0:
+                connection.execute(
+                    "INSERT INTO share_meta (key, value) VALUES ('revision', '1') "
+                    "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+                )
+                connection.execute(
+                    "INSERT OR REPLACE INTO share_meta (key, value) VALUES ('updated_at', ?)",
+                    (get_utc_iso_timestamp(),)
+                )
+
+    def get_manifest(self):
+        """返回分享清单的版本号和最后更新时间，只读取两行元数据。"""
+        values = dict(self.connection().execute("SELECT key, value FROM share_meta"))
+        return {
+            "revision": int(values.get("revision") or 0),
+            "updated_at": values.get("updated_at") or ""
+        }
+
+    def count(self):
+        """返回分享总数。"""
+        return self.connection().execute("SELECT COUNT(*) FROM shares").fetchone()[0]
+
+    def save(self, payload):
+        """写入一条分享，相同 id 覆盖。"""
+        self._insert(self.connection(), [self.build_row(payload)])
+
+    def get(self, share_id, fields=BODY_FIELDS):
+        """按 id 读取分享数据，只解压 fields 中列出的正文字段；不存在返回 None。"""
+        fields = [field for field in self.BODY_FIELDS if field in fields]
+        row = self.connection().execute(
+            f"SELECT {', '.join(['meta', *fields])} FROM shares WHERE id = ?",
+            (share_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        meta, *bodies = row
+        payload = json.loads(meta)
+        for field, data in zip(fields, bodies):
+            payload[field] = zlib.decompress(data).decode("utf-8") if data else ""
+        return payload
+
+    def iter_metadata(self, after_rowid=0):
+        """按创建时间顺序遍历分享元数据，不读取正文；after_rowid 用于只读取新写入的分享。"""
+        cursor = self.connection().execute(
+            "SELECT rowid, id, title, created_at, settings, markdown_bytes, html_bytes FROM shares "
+            "WHERE rowid > ? ORDER BY created_at, id",
+            (after_rowid,)
+        )
+        for rowid, share_id, title, created_at, settings, markdown_bytes, html_bytes in cursor:
+            yield {
+                "rowid": rowid,
+                "id": share_id,
+                "title": title,
+                "created_at": created_at,
+                "settings": json.loads(settings),
+                "markdown_bytes": markdown_bytes,
+                "html_bytes": html_bytes
+            }
+
+    def import_legacy_share(self, share_id):
+        """按需导入仓库初始化之后才出现的旧版 JSON 文件（如手工拷贝进分享目录）。"""
+        payload = read_legacy_share_file(share_id)
+        if payload is not None:
+            self._insert(self.connection(), [self.build_row(payload, share_id)], replace=False)
+        return payload
+
+    def migrate_json_dirs(self, connection):
+        """导入各分享目录中尚未入库的 <id>.json 文件，只解析新文件，返回导入数量。"""
+        known_ids = {row[0] for row in connection.execute("SELECT id FROM shares")}
+        rows = []
+        for share_dir in self.legacy_dirs:
+            if not share_dir.is_dir():
+                continue
+            for share_path in sorted(share_dir.glob("*.json")):
+                share_id = normalize_share_id(share_path.stem)
+                if not share_id or share_id != share_path.stem or share_id in known_ids:
+                    continue
+                try:
+                    payload = json.loads(share_path.read_text("utf-8"))
+                except (OSError, ValueError) as exc:
+                    app.logger.warning("Skipping unreadable share file %s: %s", share_path, exc)
+                    continue
+                known_ids.add(share_id)
+                rows.append(self.build_row(payload, share_id))
+
+        if rows:
+            self._insert(connection, rows, replace=False)
+            app.logger.info("Migrated %s share JSON files into %s", len(rows), self.db_path)
+        return len(rows)
+
+
+def get_share_repository():
+    """懒加载当前分享目录下的分享仓库。"""
+    global _SHARE_REPOSITORY
+    with _SHARE_REPOSITORY_LOCK:
+        if _SHARE_REPOSITORY is None:
+            _SHARE_REPOSITORY = ShareRepository(
+                get_active_share_storage_dir() / SHARE_DB_FILENAME,
+                legacy_dirs=list(iter_share_storage_dirs())
+            )
+        return _SHARE_REPOSITORY
+
+
+def save_share_payload(payload):
+    """保存分享数据。"""
+    get_share_repository().save(payload)
+
+
+def load_share_payload(share_id, fields=ShareRepository.BODY_FIELDS):
+    """读取分享数据，只解压 fields 中列出的正文字段；旧版 JSON 文件总是返回全部字段。"""
+    safe_id = normalize_share_id(share_id)
+    if not safe_id:
+        return None
+
+    try:
+        repository = get_share_repository()
+    except OSError as exc:
+        # 没有可写目录时仍然可以读取旧版 JSON 文件
+        app.logger.warning("Share repository unavailable, reading legacy files: %s", exc)
+        return read_legacy_share_file(safe_id)
+
+    return repository.get(safe_id, fields) or repository.import_legacy_share(safe_id)
+
+
+# 分享页直接使用保存的 HTML 和二维码，Markdown 只在需要重新推导 HTML、标题、摘要或分享图时才解压
+SHARE_PAGE_FIELDS = ("html", "qr_svg")
+SHARE_PAGE_MARKDOWN_FALLBACK_KEYS = ("html", "title", "excerpt", "og_image_url")
+
+
+def load_share_page_payload(share_id):
+    """读取渲染分享页所需的分享数据，不存在返回 None。"""
+    payload = load_share_payload(share_id, SHARE_PAGE_FIELDS)
+    if payload and not all(payload.get(key) for key in SHARE_PAGE_MARKDOWN_FALLBACK_KEYS):
+        payload = load_share_payload(share_id)
+    return payload
+
+
 def format_share_timestamp(iso_text):
     """格式化分享时间。"""
     if not iso_text:
@@ -1691,11 +2215,8 @@ def format_share_timestamp(iso_text):
     return dt.strftime("%Y-%m-%d %H:%M")
 
 
-def create_share_qr_svg(url):
-    """生成分享链接对应的二维码 SVG。"""
-    if not QR_CODE_AVAILABLE or not url:
-        return ""
-
+def build_share_qr_svg(url, svg_format="path"):
+    """生成分享链接对应的二维码 SVG，不经过缓存。"""
     qr = qrcode.QRCode(
         error_correction=qrcode.constants.ERROR_CORRECT_M,
         box_size=10,
@@ -1704,6 +2225,25 @@ def create_share_qr_svg(url):
     qr.add_data(url)
     qr.make(fit=True)
 
+    if svg_format == "compact":
+        matrix = qr.get_matrix()
+        size = len(matrix)
+        path_parts = []
+        for y, row in enumerate(matrix):
+            x = 0
+            while x < size:
+                if not row[x]:
+                    x += 1
+                    continue
+                run_start = x
+                while x < size and row[x]:
+                    x += 1
+                path_parts.append(f"M{run_start},{y}h{x - run_start}v1h-{x - run_start}z")
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{size}mm" height="{size}mm" viewBox="0 0 {size} {size}">'
+            f'<path d="{"".join(path_parts)}" fill="#000000"/></svg>'
+        )
+
     image = qr.make_image(
         image_factory=SvgPathImage,
         fill_color="#08111f",
@@ -1714,12 +2254,24 @@ def create_share_qr_svg(url):
     return buffer.getvalue().decode("utf-8")
 
 
+def create_share_qr_svg(url):
+    """返回分享链接对应的二维码 SVG；结果只取决于链接，按链接缓存在内存中。"""
+    if not QR_CODE_AVAILABLE or not url:
+        return ""
+
+    return QR_SVG_CACHE.get_or_create(
+        (QR_SVG_FORMAT, url),
+        lambda: build_share_qr_svg(url, QR_SVG_FORMAT)
+    )
+
+
 def build_share_payload(md_text, theme, code_theme, font_size, background, share_id, share_url):
     """构建分享内容。"""
     title = find_first_heading(md_text) or "未命名文章"
     plain_text = extract_plain_text_from_markdown(md_text)
     excerpt = plain_text[:160].strip()
-    html = process_markdown(md_text, theme, code_theme, font_size, background)
+    # 公式图片按内容哈希保存到分享图片目录，分享 JSON 中只保存图片地址
+    html = process_markdown(md_text, theme, code_theme, font_size, background, math_images="hosted")
     created_at = datetime.now(timezone.utc).isoformat()
     og_image_url = build_share_og_image_url(md_text, html, page_url=share_url, allow_local_copy=True)
 
@@ -1731,6 +2283,8 @@ def build_share_payload(md_text, theme, code_theme, font_size, background, share
         "html": html,
         "og_image_url": og_image_url,
         "share_url": share_url,
+        # 二维码随分享一起保存，分享页以相同地址访问时不再重新生成
+        "qr_svg": create_share_qr_svg(share_url),
         "created_at": created_at,
         "settings": {
             "theme": theme,
@@ -1741,6 +2295,192 @@ def build_share_payload(md_text, theme, code_theme, font_size, background, share
     }
 
 
+@functools.lru_cache(maxsize=1)
+def get_share_page_template_version():
+    """返回分享页模板和站点配置的摘要，模板或配置变化后旧的页面缓存自动失效。"""
+    digest = hashlib.sha256()
+    for name in SHARE_PAGE_TEMPLATES:
+        try:
+            digest.update((Path(app.root_path) / "templates" / name).read_bytes())
+        except OSError:
+            digest.update(name.encode("utf-8"))
+    for value in (SITE_NAME, GOOGLE_ANALYTICS_MEASUREMENT_ID, get_default_og_image_url(), QR_CODE_AVAILABLE, QR_SVG_FORMAT):
+        digest.update(f"\0{value}".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def build_share_page_cache_key(share_id, public_base_url):
+    """分享页缓存 key：模板版本 + 站点根地址 + 分享 ID。"""
+    raw_key = f"{get_share_page_template_version()}\0{public_base_url}\0{share_id}"
+    return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+
+def render_share_page(share_id, payload, public_base_url):
+    """渲染完整的分享页 HTML。"""
+    settings = payload.get("settings") or {}
+    theme, code_theme, font_size, background = normalize_render_options(
+        settings.get("theme", "default"),
+        settings.get("code_theme", "github"),
+        settings.get("font_size", "medium"),
+        settings.get("background", "warm")
+    )
+
+    markdown_text = payload.get("markdown", "")
+    article_html = payload.get("html") or process_markdown(
+        markdown_text,
+        theme,
+        code_theme,
+        font_size,
+        background,
+        math_images="hosted"
+    )
+    title = payload.get("title") or find_first_heading(markdown_text) or "未命名文章"
+    excerpt = trim_meta_text(payload.get("excerpt") or extract_plain_text_from_markdown(markdown_text), 180)
+    published_at = normalize_iso_timestamp(payload.get("created_at"))
+    canonical_url = build_public_url("share_article", public_base_url=public_base_url, share_id=share_id)
+    og_image_url = (
+        (payload.get("og_image_url") or "").strip()
+        or build_share_og_image_url(markdown_text, article_html, page_url=canonical_url, allow_local_copy=False)
+    )
+    if payload.get("qr_svg") and payload.get("share_url") == canonical_url:
+        page_qr_svg = payload["qr_svg"]
+    else:
+        page_qr_svg = create_share_qr_svg(canonical_url)
+
+    return render_template(
+        "share.html",
+        title=title,
+        excerpt=excerpt,
+        article_html=article_html,
+        share_url=canonical_url,
+        theme_name=THEMES[theme]["name"],
+        created_at_label=format_share_timestamp(payload.get("created_at")),
+        code_theme_name=CODE_THEMES[code_theme]["name"],
+        site_name=SITE_NAME,
+        canonical_url=canonical_url,
+        page_qr_svg=page_qr_svg,
+        published_at=published_at,
+        og_image_url=og_image_url,
+        structured_data=build_share_structured_data(
+            title,
+            excerpt or title,
+            canonical_url,
+            published_at,
+            og_image_url
+        )
+    )
+
+
+def build_share_page_entry(body, gzip_body=None):
+    """把分享页 HTML 包装成缓存条目 (正文, 强 ETag, gzip 压缩后的正文)。"""
+    if gzip_body is None:
+        gzip_body = gzip.compress(body, compresslevel=SHARE_PAGE_GZIP_LEVEL, mtime=0)
+    return body, hashlib.sha256(body).hexdigest()[:32], gzip_body
+
+
+def store_share_page(share_id, payload, public_base_url):
+    """渲染分享页并写入内存和磁盘缓存，返回缓存条目。"""
+    cache_key = build_share_page_cache_key(share_id, public_base_url)
+    body = render_share_page(share_id, payload, public_base_url).encode("utf-8")
+    entry = build_share_page_entry(body)
+    # gzip 版本保存在相邻的 .html.gz 文件
+    SHARE_PAGE_DISK_CACHE.set(cache_key, ".html", body)
+    SHARE_PAGE_DISK_CACHE.set(cache_key, ".html.gz", entry[2])
+    SHARE_PAGE_CACHE.set(cache_key, entry)
+    return entry
+
+
+def get_share_page(share_id, public_base_url):
+    """读取缓存的分享页：依次查内存、磁盘，都未命中时读取分享数据渲染；分享不存在返回 None。"""
+    share_id = normalize_share_id(share_id)
+    if not share_id:
+        return None
+    cache_key = build_share_page_cache_key(share_id, public_base_url)
+
+    def load_entry():
+        body = SHARE_PAGE_DISK_CACHE.get(cache_key, ".html")
+        if body is not None:
+            gzip_body = SHARE_PAGE_DISK_CACHE.get(cache_key, ".html.gz")
+            entry = build_share_page_entry(body, gzip_body)
+            if gzip_body is None:
+                SHARE_PAGE_DISK_CACHE.set(cache_key, ".html.gz", entry[2])
+            return entry
+
+        payload = load_share_page_payload(share_id)
+        if not payload:
+            # 通过异常返回，不存在的分享不会占用缓存
+            raise LookupError(share_id)
+        return store_share_page(share_id, payload, public_base_url)
+
+    try:
+        return SHARE_PAGE_CACHE.get_or_create(cache_key, load_entry)
+    except LookupError:
+        return None
+
+
+def warm_share_page_cache(share_id, payload, public_base_url):
+    """创建分享后立即渲染分享页，首个访问者也不需要等待渲染；配置了静态导出目录时同时导出。失败只记录日志。"""
+    try:
+        entry = store_share_page(share_id, payload, public_base_url)
+        if SHARE_STATIC_EXPORT_DIR:
+            export_static_share_page(share_id, entry, SHARE_STATIC_EXPORT_DIR)
+    except Exception as exc:
+        app.logger.warning("Share page warm-up failed share_id=%s error=%s", share_id, exc)
+
+
+SHARE_IMAGE_REFERENCE_PATTERN = re.compile(re.escape(SHARE_IMAGE_URL_PREFIX) + r'([^"\'\s<>?#()]+)')
+
+
+def write_file_atomic(path, data):
+    """先写临时文件再替换，nginx 不会读到写了一半的文件。"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=str(path.parent), suffix=".tmp", delete=False) as fp:
+        fp.write(data)
+        temp_path = Path(fp.name)
+    os.chmod(temp_path, 0o644)
+    os.replace(temp_path, path)
+
+
+def export_static_share_page(share_id, entry, export_dir):
+    """把渲染好的分享页及其引用的分享图片写入静态导出目录，返回导出的图片数量。"""
+    body, _, gzip_body = entry
+    share_dir = Path(export_dir).expanduser() / "share"
+    image_count = 0
+    # 图片先于页面写入，页面出现时引用的图片已经可以访问
+    for filename in sorted(set(SHARE_IMAGE_REFERENCE_PATTERN.findall(body.decode("utf-8")))):
+        filename = urllib.parse.unquote(filename)
+        source_path = find_share_image_path(filename)
+        target_path = share_dir / "images" / filename
+        if source_path is None or target_path.exists():
+            continue
+        target_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # 同一文件系统上用硬链接，不额外占用磁盘
+            os.link(source_path, target_path)
+        except OSError:
+            write_file_atomic(target_path, source_path.read_bytes())
+        image_count += 1
+
+    write_file_atomic(share_dir / f"{share_id}.html.gz", gzip_body)
+    write_file_atomic(share_dir / f"{share_id}.html", body)
+    return image_count
+
+
+def export_all_static_share_pages(export_dir, public_base_url):
+    """按当前模板重新渲染全部分享页并导出为静态文件，返回 (分享数, 图片数)。需要在应用上下文中调用。"""
+    repository = get_share_repository()
+    share_count = 0
+    image_count = 0
+    for metadata in repository.iter_metadata():
+        payload = load_share_page_payload(metadata["id"])
+        if payload is None:
+            continue
+        entry = store_share_page(metadata["id"], payload, public_base_url)
+        image_count += export_static_share_page(metadata["id"], entry, export_dir)
+        share_count += 1
+    return share_count, image_count
+
+
 def guess_extension_from_mime(mime_type):
     """根据 MIME 类型推断文件扩展名。"""
     if not mime_type:
@@ -1772,6 +2512,10 @@ def resolve_local_resource_path(source):
     if not source:
         return None
 
+    if source.startswith(SHARE_IMAGE_URL_PREFIX):
+        # 站内分享图片（如按内容哈希保存的公式图片）直接读取分享图片目录
+        return find_share_image_path(urllib.parse.unquote(source[len(SHARE_IMAGE_URL_PREFIX):]))
+
     candidates = []
     source_path = Path(source)
     if source_path.is_absolute():
@@ -2133,9 +2877,15 @@ def replace_mermaid_blocks_for_wechat(html_content):
     return pattern.sub(repl, html_content)
 
 
-def replace_content_images_with_wechat_urls(html_content, access_token):
-    """上传正文中的图片到微信并替换为微信地址。"""
+def replace_content_images_with_wechat_urls(html_content, access_token, account_key=""):
+    """上传正文中的图片到微信并替换为微信地址。
+
+    相同内容的图片只上传一次；提供 account_key（公众号 AppKey）时，按「账号 + 图片内容哈希」记住微信地址，
+    之后的草稿中再出现相同图片（如同一个公式）直接复用。返回 (替换后的 HTML, 实际上传张数, 复用已有地址张数)。
+    """
     upload_cache = {}
+    uploaded_urls = {}
+    counts = {"uploaded": 0, "reused": 0}
     pattern = re.compile(r'(<img\b[^>]*\bsrc=["\'])([^"\']+)(["\'][^>]*>)', re.IGNORECASE)
 
     def repl(match):
@@ -2154,17 +2904,31 @@ def replace_content_images_with_wechat_urls(html_content, access_token):
                 WECHAT_INLINE_IMAGE_MAX_BYTES,
                 "正文图片"
             )
-            upload_cache[source] = wechat_upload_article_image(
-                access_token,
-                normalized_bytes,
-                normalized_name,
-                normalized_mime
-            )
+            content_key = build_render_cache_key(hashlib.sha256(normalized_bytes).hexdigest(), account_key)
+            if content_key not in uploaded_urls:
+                cached_url = WECHAT_IMAGE_URL_CACHE.get(content_key, ".url") if account_key else None
+                if cached_url is not None:
+                    increment_metric("wechat.image.upload_reused")
+                    counts["reused"] += 1
+                    uploaded_urls[content_key] = cached_url.decode("utf-8")
+                else:
+                    image_url = wechat_upload_article_image(
+                        access_token,
+                        normalized_bytes,
+                        normalized_name,
+                        normalized_mime
+                    )
+                    increment_metric("wechat.image.uploaded")
+                    counts["uploaded"] += 1
+                    if account_key:
+                        WECHAT_IMAGE_URL_CACHE.set(content_key, ".url", image_url.encode("utf-8"))
+                    uploaded_urls[content_key] = image_url
+            upload_cache[source] = uploaded_urls[content_key]
 
         return f"{match.group(1)}{upload_cache[source]}{match.group(3)}"
 
     replaced_html = pattern.sub(repl, html_content)
-    return replaced_html, len(upload_cache)
+    return replaced_html, counts["uploaded"], counts["reused"]
 
 
 def extract_first_markdown_image_source(md_text):
@@ -2195,7 +2959,7 @@ def coerce_bool_flag(value, default):
     return 1 if str(value).strip().lower() in {"1", "true", "yes", "on"} else 0
 
 
-def prepare_wechat_article_payload(md_text, theme, code_theme, font_size, background, access_token, meta=None):
+def prepare_wechat_article_payload(md_text, theme, code_theme, font_size, background, access_token, meta=None, account_key=""):
     """组装公众号草稿文章数据。"""
     meta = meta or {}
     title = (meta.get("title") or find_first_heading(md_text) or "未命名文章").strip()
@@ -2203,9 +2967,13 @@ def prepare_wechat_article_payload(md_text, theme, code_theme, font_size, backgr
     author = (meta.get("author") or "").strip()
     content_source_url = (meta.get("content_source_url") or "").strip()
 
-    html_content = process_markdown(md_text, theme, code_theme, font_size, background)
+    html_content = process_markdown(md_text, theme, code_theme, font_size, background, math_images="hosted")
     html_content = replace_mermaid_blocks_for_wechat(html_content)
-    html_content, uploaded_image_count = replace_content_images_with_wechat_urls(html_content, access_token)
+    html_content, uploaded_image_count, reused_image_count = replace_content_images_with_wechat_urls(
+        html_content,
+        access_token,
+        account_key=account_key
+    )
 
     cover_source = (
         (meta.get("cover_image") or "").strip()
@@ -2243,7 +3011,8 @@ def prepare_wechat_article_payload(md_text, theme, code_theme, font_size, backgr
             "need_open_comment": coerce_bool_flag(meta.get("need_open_comment"), 1),
             "only_fans_can_comment": coerce_bool_flag(meta.get("only_fans_can_comment"), 0)
         },
-        "uploaded_image_count": uploaded_image_count
+        "uploaded_image_count": uploaded_image_count,
+        "reused_image_count": reused_image_count
     }
 
 
@@ -3034,162 +3803,1486 @@ def run_article_illustration_job(job_id, md_text, style_key, ai_config, public_b
         app.logger.exception("Illustrate article job failed job_id=%s", job_id)
 
 
-def highlight_code(code, language, style_name):
-    """使用 Pygments 高亮代码"""
-    try:
-        lexer = get_lexer_by_name(language, stripall=True)
-    except:
-        try:
-            lexer = guess_lexer(code)
-        except:
-            lexer = get_lexer_by_name('text', stripall=True)
-
-    try:
-        style = get_style_by_name(style_name)
-    except:
-        style = get_style_by_name('default')
+def estimate_cache_value_size(value):
+    """估算缓存值占用的内存字节数。"""
+    return sys.getsizeof(value)
+
+
+class BoundedLRUCache:
+    """按条目数和字节预算淘汰的线程安全 LRU 缓存，相同 key 的并发计算只执行一次。"""
+
+    def __init__(self, name, max_entries, max_bytes, sizeof=None):
+        self.name = name
+        self.max_entries = max(0, int(max_entries))
+        self.max_bytes = max(0, int(max_bytes))
+        self._sizeof = sizeof or estimate_cache_value_size
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key, default=None):
+        """读取缓存并刷新最近使用顺序。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value):
+        """写入缓存，超出预算时从最久未使用的条目开始淘汰。"""
+        if not self.enabled:
+            return
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
 
-    formatter = HtmlFormatter(
-        style=style,
-        nowrap=True,
-        noclasses=True,
-        prestyles='margin:0;padding:0;background:transparent;'
-    )
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def get_or_create(self, key, factory, cacheable=None):
+        """命中则直接返回；未命中时只让一个线程执行 factory，其余线程等待其结果。
+
+        cacheable(value) 返回 False 时结果只交给本次等待的线程，不写入缓存。
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            pending = self._inflight.get(key)
+            is_owner = pending is None
+            if is_owner:
+                pending = {"event": threading.Event(), "value": None, "error": None}
+                self._inflight[key] = pending
+                self.misses += 1
+            else:
+                self.coalesced += 1
 
-    return highlight(code, lexer, formatter)
+        if not is_owner:
+            pending["event"].wait()
+            if pending["error"] is not None:
+                raise pending["error"]
+            return pending["value"]
 
+        try:
+            value = factory()
+            pending["value"] = value
+            if cacheable is None or cacheable(value):
+                self.set(key, value)
+            return value
+        except Exception as exc:
+            pending["error"] = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending["event"].set()
+
+    def clear(self):
+        """清空缓存内容，保留统计计数。"""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """返回缓存命中率等统计信息。"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
 
-def render_latex_to_base64(latex_code, theme_config=None):
-    """将 LaTeX 公式渲染为 base64 编码的图片（使用在线服务）"""
-    try:
-        # 获取主题背景色和文字颜色
-        bg_color = 'FFFFFF'
-        text_color = '000000'
-        if theme_config and 'styles' in theme_config:
-            bg = theme_config['styles'].get('bg_color', '#ffffff')
-            txt = theme_config['styles'].get('text_color', '#333333')
-            bg_color = bg.lstrip('#')
-            text_color = txt.lstrip('#')
-
-        # 判断是否为深色背景
-        # 计算背景亮度
-        r, g, b = int(bg_color[0:2], 16), int(bg_color[2:4], 16), int(bg_color[4:6], 16)
-        is_dark = (r * 0.299 + g * 0.587 + b * 0.114) < 128
 
-        # 使用 CodeCogs 在线 LaTeX 渲染服务
-        # 对于深色背景，使用白色文字
-        if is_dark:
-            latex_code = f"\\color{{white}}{{{latex_code}}}"
+RENDER_CACHE = BoundedLRUCache("render", RENDER_CACHE_MAX_ENTRIES, RENDER_CACHE_MAX_BYTES)
+BLOCK_RENDER_CACHE = BoundedLRUCache("render_blocks", BLOCK_RENDER_CACHE_MAX_ENTRIES, BLOCK_RENDER_CACHE_MAX_BYTES)
+HIGHLIGHT_CACHE = BoundedLRUCache("highlight", HIGHLIGHT_CACHE_MAX_ENTRIES, HIGHLIGHT_CACHE_MAX_BYTES)
+# 只保存 lexer 别名，字节预算按条目数估算即可
+LANGUAGE_DETECTION_CACHE = BoundedLRUCache(
+    "language_detection",
+    LANGUAGE_DETECTION_CACHE_MAX_ENTRIES,
+    LANGUAGE_DETECTION_CACHE_MAX_ENTRIES * 1024
+)
+
+
+class DiskBlobCache:
+    """内容寻址的磁盘缓存，多个 gunicorn worker 共享同一目录；超出字节预算时按修改时间淘汰最旧的文件。"""
+
+    # 每写入约 1/20 预算的数据才重新扫描一次目录，避免每次写入都统计全部文件
+    SCAN_INTERVAL_RATIO = 20
+
+    def __init__(self, name, directory, max_bytes):
+        self.name = name
+        self.directory = Path(directory)
+        self.max_bytes = max(0, int(max_bytes))
+        self._lock = threading.Lock()
+        self._bytes_since_scan = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _path_for(self, key, suffix):
+        return self.directory / key[:2] / f"{key}{suffix}"
+
+    def contains(self, key, suffix):
+        """判断缓存文件是否存在，不计入命中统计。"""
+        return self.enabled and self._path_for(key, suffix).exists()
+
+    def get(self, key, suffix):
+        """读取缓存文件内容，命中时刷新修改时间。"""
+        if not self.enabled:
+            return None
+        path = self._path_for(key, suffix)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            data = None
+        except OSError as exc:
+            app.logger.warning("Disk cache %s read failed: %s", self.name, exc)
+            data = None
+            with self._lock:
+                self.errors += 1
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
 
-        encoded_latex = urllib.parse.quote(latex_code)
-        url = f"https://latex.codecogs.com/png.latex?\\dpi{{150}}{encoded_latex}"
+    def set(self, key, suffix, data):
+        """原子写入缓存文件，写入失败只记录日志，不影响渲染。"""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        path = self._path_for(key, suffix)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=str(path.parent), suffix=".tmp", delete=False) as fp:
+                fp.write(data)
+                temp_path = Path(fp.name)
+            os.replace(temp_path, path)
+        except OSError as exc:
+            app.logger.warning("Disk cache %s write failed: %s", self.name, exc)
+            with self._lock:
+                self.errors += 1
+            return
 
-        # 获取图片
-        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req, timeout=10) as response:
-            img_data = response.read()
+        with self._lock:
+            self.writes += 1
+            self._bytes_since_scan += len(data)
+            should_scan = self._bytes_since_scan * self.SCAN_INTERVAL_RATIO >= self.max_bytes
+            if should_scan:
+                self._bytes_since_scan = 0
+        if should_scan:
+            self.evict()
+
+    def iter_files(self):
+        """遍历缓存文件，返回 (路径, 大小, 修改时间)。"""
+        if not self.directory.is_dir():
+            return
+        for bucket in os.scandir(self.directory):
+            if not bucket.is_dir():
+                continue
+            for entry in os.scandir(bucket.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield Path(entry.path), stat.st_size, stat.st_mtime
 
-        img_base64 = base64.b64encode(img_data).decode('utf-8')
-        return f'data:image/png;base64,{img_base64}'
-    except Exception as e:
-        # 如果在线服务失败，尝试使用 matplotlib 本地渲染（简单公式）
+    def evict(self):
+        """总大小超出预算时删除最久未使用的文件，直到降到预算的 90%。"""
         try:
-            return render_latex_local(latex_code, theme_config)
-        except:
-            return None
+            files = list(self.iter_files())
+        except OSError as exc:
+            app.logger.warning("Disk cache %s scan failed: %s", self.name, exc)
+            return
+
+        total_bytes = sum(size for _, size, _ in files)
+        if total_bytes <= self.max_bytes:
+            return
+
+        target_bytes = self.max_bytes * 9 // 10
+        evicted = 0
+        for path, size, _ in sorted(files, key=lambda item: item[2]):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            total_bytes -= size
+            evicted += 1
+
+        with self._lock:
+            self.evictions += evicted
+
+    def stats(self):
+        """返回当前进程视角的命中统计。"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "directory": str(self.directory),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "errors": self.errors,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+FORMULA_CACHE = DiskBlobCache("formula", FORMULA_CACHE_DIR, FORMULA_CACHE_MAX_BYTES)
+# 延迟加载公式的内容记录单独存放，不会因公式图片占满预算而被淘汰，缓存中的预览 HTML 引用的地址一直可用
+FORMULA_SPEC_CACHE = DiskBlobCache("formula_spec", FORMULA_SPEC_DIR, FORMULA_SPEC_CACHE_MAX_BYTES)
+# 记录已上传到微信的正文图片地址，值只是一个 URL，预算很小
+WECHAT_IMAGE_URL_CACHE = DiskBlobCache(
+    "wechat_image_url",
+    Path(app.instance_path) / "wechat_image_cache",
+    WECHAT_IMAGE_URL_CACHE_MAX_BYTES
+)
+QR_SVG_CACHE = BoundedLRUCache("qr_svg", QR_SVG_CACHE_MAX_ENTRIES, QR_SVG_CACHE_MAX_ENTRIES * 16 * 1024)
+# 渲染好的分享页：内存缓存供当前 worker 直接返回，磁盘缓存让创建分享时的预热对所有 worker 生效
+SHARE_PAGE_CACHE = BoundedLRUCache(
+    "share_page",
+    SHARE_PAGE_CACHE_MAX_ENTRIES,
+    SHARE_PAGE_CACHE_MAX_BYTES,
+    sizeof=lambda entry: len(entry[0]) + len(entry[2])
+)
+SHARE_PAGE_DISK_CACHE = DiskBlobCache(
+    "share_page_disk",
+    Path(app.instance_path) / "share_page_cache",
+    SHARE_PAGE_DISK_CACHE_MAX_BYTES
+)
+
+
+class CircuitBreaker:
+    """外部服务熔断器：连续失败达到阈值后断开，断开期间直接跳过该服务，由后台线程定期探测，恢复后自动闭合。"""
+
+    def __init__(self, name, failure_threshold, probe_interval, probe):
+        self.name = name
+        self.failure_threshold = max(0, int(failure_threshold))
+        self.probe_interval = max(1, int(probe_interval))
+        self._probe = probe
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.last_error = ""
+        self.trips = 0
+        self.short_circuited = 0
+        self.probes = 0
+        self.probe_failures = 0
+
+    @property
+    def enabled(self):
+        return self.failure_threshold > 0
+
+    def allow_request(self):
+        """断开状态下返回 False，调用方应直接走兜底路径。"""
+        with self._lock:
+            if self.state == "open":
+                self.short_circuited += 1
+                return False
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self, error):
+        """记录一次失败，连续失败达到阈值时断开并启动后台探测。"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = str(error)[:200]
+            if not self.enabled or self.state == "open" or self.consecutive_failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self.opened_at = get_utc_timestamp()
+            self.trips += 1
+
+        app.logger.warning(
+            "Circuit %s opened after %s consecutive failures: %s",
+            self.name,
+            self.failure_threshold,
+            self.last_error
+        )
+        threading.Thread(target=self._probe_until_recovered, name=f"{self.name}-probe", daemon=True).start()
+
+    def _probe_until_recovered(self):
+        """断开期间每隔 probe_interval 秒探测一次，成功后闭合。"""
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self._probe()
+            except Exception as exc:
+                with self._lock:
+                    self.probes += 1
+                    self.probe_failures += 1
+                    self.last_error = str(exc)[:200]
+                app.logger.info("Circuit %s probe failed: %s", self.name, exc)
+                continue
+
+            with self._lock:
+                self.probes += 1
+                self.state = "closed"
+                self.consecutive_failures = 0
+                self.opened_at = None
+            app.logger.info("Circuit %s closed after successful probe", self.name)
+            return
+
+    def stats(self):
+        """返回当前进程内的熔断状态。"""
+        with self._lock:
+            return {
+                "state": self.state,
+                "failure_threshold": self.failure_threshold,
+                "probe_interval_seconds": self.probe_interval,
+                "consecutive_failures": self.consecutive_failures,
+                "opened_at": self.opened_at,
+                "last_error": self.last_error,
+                "trips": self.trips,
+                "short_circuited": self.short_circuited,
+                "probes": self.probes,
+                "probe_failures": self.probe_failures
+            }
+
+
+_METRICS_LOCK = threading.Lock()
+_METRIC_COUNTERS = {}
+
+
+def increment_metric(name, amount=1):
+    """累加进程内计数器，供 /api/metrics 输出。"""
+    with _METRICS_LOCK:
+        _METRIC_COUNTERS[name] = _METRIC_COUNTERS.get(name, 0) + amount
+
+
+def get_metric_counters():
+    """返回计数器快照。"""
+    with _METRICS_LOCK:
+        return dict(sorted(_METRIC_COUNTERS.items()))
+
+
+def collect_cache_stats():
+    """汇总各个进程内缓存的统计信息。"""
+    return {
+        cache.name: cache.stats()
+        for cache in (
+            RENDER_CACHE,
+            BLOCK_RENDER_CACHE,
+            HIGHLIGHT_CACHE,
+            LANGUAGE_DETECTION_CACHE,
+            FORMULA_CACHE,
+            FORMULA_SPEC_CACHE,
+            WECHAT_IMAGE_URL_CACHE,
+            SITEMAP_CACHE,
+            QR_SVG_CACHE,
+            SHARE_PAGE_CACHE,
+            SHARE_PAGE_DISK_CACHE
+        )
+    }
+
+
+def collect_circuit_breaker_stats():
+    """汇总外部服务熔断器的状态。"""
+    return {breaker.name: breaker.stats() for breaker in (REMOTE_MATH_BREAKER,)}
+
+
+def normalize_markdown_newlines(md_text):
+    """统一 Markdown 换行符，保证相同内容得到相同的缓存 key。"""
+    return (md_text or "").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def build_render_cache_key(md_text, *options):
+    """根据正文和渲染参数生成内容寻址的缓存 key。"""
+    digest = hashlib.sha256(md_text.encode("utf-8"))
+    for option in options:
+        digest.update(b"\0")
+        digest.update(str(option).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def process_markdown_cached(md_text, theme="default", code_theme="github", font_size="medium", background="warm", incremental=False, math_format="png", math_images="inline"):
+    """带渲染缓存的 process_markdown，相同输入只渲染一次。"""
+    md_text = normalize_markdown_newlines(md_text)
+    cache_key = build_render_cache_key(
+        md_text,
+        theme,
+        code_theme,
+        font_size,
+        background,
+        "incremental" if incremental else "full",
+        math_format,
+        math_images
+    )
+    return RENDER_CACHE.get_or_create(
+        cache_key,
+        lambda: process_markdown(
+            md_text,
+            theme,
+            code_theme,
+            font_size,
+            background,
+            incremental=incremental,
+            math_format=math_format,
+            math_images=math_images
+        ),
+        cacheable=is_render_cacheable
+    )
+
+
+# 流式渲染中途失败时追加的结尾标记，客户端据此丢弃不完整的内容并改用 /api/convert
+STREAM_RENDER_ERROR_MARKER = "<!--md2-stream-error-->"
+
+
+def iter_markdown_render_stream(md_text, theme="default", code_theme="github", font_size="medium", background="warm", math_format="png", math_images="inline"):
+    """按顶层块逐段产出带样式的 HTML，拼接结果与 process_markdown_cached(incremental=True) 一致。"""
+    md_text = normalize_markdown_newlines(md_text)
+    cache_key = build_render_cache_key(
+        md_text, theme, code_theme, font_size, background, "incremental", math_format, math_images
+    )
+    cached_html = RENDER_CACHE.get(cache_key)
+    if cached_html is not None:
+        yield cached_html
+        return
+
+    stylesheet = get_render_stylesheet(theme, code_theme, font_size, background)
+    chunks = [f'<section style="{stylesheet["wrapper"]}">\n']
+    yield chunks[0]
+
+    for index, segment in enumerate(split_markdown_render_segments(md_text)):
+        segment_html = render_markdown_segment_cached(
+            segment, theme, code_theme, font_size, background, math_format, math_images
+        )
+        chunk = f'\n{segment_html}' if index else segment_html
+        chunks.append(chunk)
+        yield chunk
+
+    chunks.append('\n</section>')
+    yield chunks[-1]
+    html = "".join(chunks)
+    if is_render_cacheable(html):
+        RENDER_CACHE.set(cache_key, html)
+
+
+_BATCH_RENDER_POOL = None
+_BATCH_RENDER_POOL_LOCK = threading.Lock()
+
+
+def get_batch_render_pool():
+    """懒加载批量渲染进程池；gunicorn 线程模式下 fork 不安全，子进程使用 spawn 启动。"""
+    global _BATCH_RENDER_POOL
+    with _BATCH_RENDER_POOL_LOCK:
+        if _BATCH_RENDER_POOL is None:
+            _BATCH_RENDER_POOL = ProcessPoolExecutor(
+                max_workers=BATCH_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _BATCH_RENDER_POOL
+
+
+def reset_batch_render_pool(pool):
+    """进程池异常退出后丢弃，下次请求重新创建。"""
+    global _BATCH_RENDER_POOL
+    with _BATCH_RENDER_POOL_LOCK:
+        if _BATCH_RENDER_POOL is pool:
+            _BATCH_RENDER_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_markdown_batch_group(md_text, option_sets):
+    """同一篇文档只解析一次，再按多组渲染参数分别渲染；返回 (解析耗时, [(html, 渲染耗时)])。"""
+    started_at = time.perf_counter()
+    parsed = parse_markdown_document(md_text)
+    parse_ms = (time.perf_counter() - started_at) * 1000
+
+    results = []
+    for options in option_sets:
+        started_at = time.perf_counter()
+        styled_content = render_parsed_markdown(parsed, *options)
+        html = wrap_styled_html(styled_content, get_render_stylesheet(*options[:4]))
+        results.append((html, (time.perf_counter() - started_at) * 1000))
+    return parse_ms, results
+
+
+def render_markdown_batch(jobs):
+    """批量渲染 [(markdown, (theme, code_theme, font_size, background, math_format, math_images))]，结果顺序与 jobs 一致。
+
+    已缓存的任务直接返回；其余按文档分组，同一文档的多个主题共享一次解析，多篇文档分发到进程池并行渲染。
+    """
+    results = [None] * len(jobs)
+    groups = OrderedDict()
+    for index, (md_text, options) in enumerate(jobs):
+        md_text = normalize_markdown_newlines(md_text)
+        # 与 process_markdown_cached 的缓存键顺序保持一致，批量和单篇接口共享渲染缓存
+        cache_key = build_render_cache_key(md_text, *options[:4], "full", *options[4:])
+        cached_html = RENDER_CACHE.get(cache_key)
+        if cached_html is not None:
+            results[index] = {"html": cached_html, "cached": True, "timings": {"parse_ms": 0.0, "render_ms": 0.0}}
+            continue
+        group = groups.setdefault(md_text, OrderedDict())
+        group.setdefault(options, []).append((index, cache_key))
+
+    def collect(md_text, group, run):
+        try:
+            parse_ms, rendered = run()
+        except Exception as exc:
+            app.logger.warning("Batch render group failed: %s", exc)
+            for targets in group.values():
+                for index, _ in targets:
+                    results[index] = {"error": str(exc)}
+            return
+
+        shared_jobs = sum(len(targets) for targets in group.values())
+        for targets, (html, render_ms) in zip(group.values(), rendered):
+            for index, cache_key in targets:
+                if is_render_cacheable(html):
+                    RENDER_CACHE.set(cache_key, html)
+                results[index] = {
+                    "html": html,
+                    "cached": False,
+                    "timings": {
+                        "parse_ms": round(parse_ms, 3),
+                        "render_ms": round(render_ms, 3),
+                        "shared_parse_jobs": shared_jobs
+                    }
+                }
+
+    if len(groups) > 1 and BATCH_RENDER_WORKERS > 1:
+        pool = get_batch_render_pool()
+        try:
+            futures = [
+                (md_text, group, pool.submit(render_markdown_batch_group, md_text, list(group)))
+                for md_text, group in groups.items()
+            ]
+        except BrokenProcessPool:
+            reset_batch_render_pool(pool)
+            raise
+        for md_text, group, future in futures:
+            collect(md_text, group, future.result)
+        if any(isinstance(future.exception(), BrokenProcessPool) for _, _, future in futures):
+            reset_batch_render_pool(pool)
+    else:
+        for md_text, group in groups.items():
+            collect(md_text, group, lambda: render_markdown_batch_group(md_text, list(group)))
+
+    return results
+
+
+MARKDOWN_REFERENCE_DEFINITION_PATTERN = re.compile(r"^\s{0,3}\[[^\]]+\]:\s*\S", re.MULTILINE)
+MARKDOWN_LIST_ITEM_PATTERN = re.compile(r"^\s{0,3}(?:[-*+]|\d+[.)])\s")
+MARKDOWN_HTML_BLOCK_PATTERN = re.compile(r"^\s{0,3}<([A-Za-z][A-Za-z0-9-]*)")
+MARKDOWN_HTML_BLOCK_BOUNDARY_PATTERN = re.compile(r"^\s{0,3}</?[A-Za-z!]")
+MARKDOWN_HTML_BLOCK_START_PATTERN = re.compile(r"(?:\A|\n[ \t]*\n)[ ]{0,3}<([A-Za-z][A-Za-z0-9-]*)")
+HTML_VOID_TAGS = {"area", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+
+def find_leading_math_token(block_text):
+    """返回块中先出现的是公式分隔符（"math"）还是代码（"code"），都没有返回 None。"""
+    if "$" not in block_text and "`" not in block_text:
+        return None
+    for start, end, is_code in iter_markdown_code_spans(block_text):
+        if is_code:
+            return "code"
+        if MATH_DELIMITER_PATTERN.search(block_text, start, end):
+            return "math"
+    return None
+
+
+def get_trailing_prose(stripped_text):
+    """返回提取公式后的文本中最后一段正文（最后一处代码之后）。"""
+    if "`" not in stripped_text:
+        return stripped_text
+    trailing_start = 0
+    for start, end, is_code in iter_markdown_code_spans(stripped_text):
+        if is_code:
+            trailing_start = end
+    return stripped_text[trailing_start:]
+
+
+def is_slider_open(slider_open, text):
+    """按 <!...> 幻灯片语法（非贪婪匹配到下一个 >）扫描 text，返回扫描结束时是否仍有未闭合的 <!。"""
+    position = 0
+    while True:
+        if slider_open:
+            # .+? 至少匹配一个字符，紧跟在 <! 后面的 > 不算闭合
+            close_at = text.find(">", position)
+            if close_at < 0:
+                return True
+            position = close_at + 1
+            slider_open = False
+        else:
+            open_at = text.find("<!", position)
+            if open_at < 0:
+                return False
+            position = open_at + 3
+            slider_open = True
+
+
+class MarkdownSegmentState:
+    """增量记录片段中跨空行延续的结构：代码围栏、未配对的公式分隔符、幻灯片和未闭合的 HTML 块。
+
+    每次只扫描新追加的文本，切分整篇文章保持线性时间。出现未配对的分隔符后，之后的文本暂存起来，
+    只有新文本可能改变配对结果时才对暂存部分重新提取公式。
+    """
+
+    HTML_TAG_PATTERN = re.compile(r"<(/?)([a-z][a-z0-9-]*)\b")
+
+    def __init__(self):
+        self.fence_count = 0
+        self.slider_open = False
+        self.tag_depth = {}
+        self.html_block_tags = set()
+        self.at_block_start = True
+        # 从含未配对分隔符的文本开始追加的内容、开始前的 HTML 状态，以及其中是否有未配对的 $$
+        self.pending_math = []
+        self.pending_base = None
+        self.pending_block_math = False
+        # 暂存部分的 HTML 状态是按单块提取公式估算的，需要时再按整段重算
+        self.pending_estimated = False
+
+    def scan_html(self, text, at_block_start):
+        """记录以 HTML 标签开头的块，并按标签累计嵌套深度；闭合标签多于开始标签时深度不低于 0。"""
+        scan_text = text if at_block_start else "\n" + text
+        for match in MARKDOWN_HTML_BLOCK_START_PATTERN.finditer(scan_text):
+            tag_name = match.group(1).lower()
+            if tag_name not in HTML_VOID_TAGS:
+                self.html_block_tags.add(tag_name)
+        for match in self.HTML_TAG_PATTERN.finditer(text.lower()):
+            depth = self.tag_depth.get(match.group(2), 0)
+            self.tag_depth[match.group(2)] = max(depth - 1, 0) if match.group(1) else depth + 1
+
+    def append(self, text):
+        """追加一段文本（与已有内容之间以换行连接）并更新状态。"""
+        self.fence_count += text.count("```")
+        self.slider_open = is_slider_open(self.slider_open, text)
+
+        if not self.pending_math:
+            if "$" in text:
+                self.pending_base = (dict(self.tag_depth), set(self.html_block_tags), self.at_block_start)
+                self.pending_math.append(text)
+                self.resolve_pending_math()
+            else:
+                self.scan_html(text, self.at_block_start)
+        else:
+            self.pending_math.append(text)
+            if "$" not in text and "`" not in text:
+                # 没有分隔符和代码的文本不改变配对结果，提取公式后原样保留
+                self.scan_html(text, self.at_block_start)
+            elif "`" not in text and self.keeps_pending_math(text):
+                self.pending_estimated = True
+                self.scan_html(extract_math_formulas(text)[0], self.at_block_start)
+            else:
+                self.resolve_pending_math()
+
+        self.at_block_start = not text.rsplit("\n", 1)[-1].strip()
+
+    def keeps_pending_math(self, text):
+        """判断追加 text 后暂存部分是否一定仍有未配对的分隔符，此时不必重新提取整段公式。
+
+        单独看 text 时公式全部配对，它就不会改变之前落单的 $；之前有落单的 $$ 时，只要 text 中没有 $$ 即可。
+        """
+        if self.pending_block_math:
+            return "$$" not in text
+        stripped_text = extract_math_formulas(text)[0]
+        return "$$" not in stripped_text and MATH_INLINE_DELIMITER_PATTERN.search(stripped_text) is None
+
+    def resolve_pending_math(self):
+        """对暂存部分重新提取公式，闭合标签可能被跨块的公式吞掉，HTML 状态也按提取后的文本重算。"""
+        tag_depth, html_block_tags, at_block_start = self.pending_base
+        self.tag_depth = dict(tag_depth)
+        self.html_block_tags = set(html_block_tags)
+        stripped_text = extract_math_formulas("\n".join(self.pending_math))[0]
+        self.scan_html(stripped_text, at_block_start)
+        self.pending_estimated = False
+
+        trailing_prose = get_trailing_prose(stripped_text) if "$" in stripped_text else ""
+        if MATH_DELIMITER_PATTERN.search(trailing_prose) is None:
+            self.pending_math = []
+            self.pending_base = None
+            self.pending_block_math = False
+        else:
+            self.pending_block_math = "$$" in trailing_prose
+
+    def is_open(self, math_follows=True):
+        """判断后一个块是否必须并入当前片段。
+
+        math_follows 表示后文在下一处代码之前还有公式分隔符；没有时片段末尾落单的 $（如价格）不会与后文配对。
+        """
+        if self.fence_count % 2 or self.slider_open:
+            return True
+        if self.pending_math:
+            if math_follows:
+                return True
+            if self.pending_estimated:
+                self.resolve_pending_math()
+        # 任一以 HTML 标签开头的块未闭合时，Markdown 会把之后的内容一直当作原始 HTML
+        return any(self.tag_depth.get(tag_name) for tag_name in self.html_block_tags)
+
+
+def should_merge_markdown_blocks(previous_block, next_block, in_list=False):
+    """判断下一个块在整篇渲染时是否会与前面的块被 Markdown 视为同一结构。
+
+    in_list 表示片段中最后一个没有缩进的块是列表项：缩进的续行段落不会结束列表，之后的列表项仍属于同一个列表。
+    """
+    if next_block[:1] in (" ", "\t"):
+        return True
+    if in_list and MARKDOWN_LIST_ITEM_PATTERN.match(next_block):
+        return True
+    if previous_block.lstrip().startswith(">") and next_block.lstrip().startswith(">"):
+        return True
+    # 原始 HTML 块与后一个块之间的空行由 Markdown 原样输出，单独渲染会丢失
+    if MARKDOWN_HTML_BLOCK_BOUNDARY_PATTERN.match(previous_block):
+        return True
+    return False
+
+
+def split_markdown_render_segments(md_text):
+    """将文章切分为可独立渲染的顶层片段，无法安全切分的部分合并在一起。"""
+    md_text = normalize_markdown_newlines(md_text)
+    if MARKDOWN_REFERENCE_DEFINITION_PATTERN.search(md_text):
+        return [md_text] if md_text.strip() else []
+
+    lines = md_text.split("\n")
+    blocks = [
+        (block, "\n".join(lines[block["start_line"]:block["end_line"] + 1]))
+        for block in parse_markdown_blocks(md_text)
+    ]
+    # math_follows[i]：第 i 个块及之后的块中，下一处代码之前是否还有公式分隔符
+    math_follows = [False] * (len(blocks) + 1)
+    for index in range(len(blocks) - 1, -1, -1):
+        token = find_leading_math_token(blocks[index][1])
+        math_follows[index] = token == "math" if token else math_follows[index + 1]
+
+    segments = []
+    current_lines = []
+    current_end = -1
+    last_block = ""
+    in_list = False
+    state = None
+
+    for index, (block, block_text) in enumerate(blocks):
+        if current_lines and (
+            state.is_open(math_follows[index])
+            or should_merge_markdown_blocks(last_block, block_text, in_list)
+        ):
+            appended_lines = lines[current_end + 1:block["end_line"] + 1]
+            current_lines.extend(appended_lines)
+            state.append("\n".join(appended_lines))
+        else:
+            if current_lines:
+                segments.append("\n".join(current_lines))
+            current_lines = lines[block["start_line"]:block["end_line"] + 1]
+            state = MarkdownSegmentState()
+            state.append("\n".join(current_lines))
+            in_list = False
+        if block_text[:1] not in (" ", "\t"):
+            in_list = bool(MARKDOWN_LIST_ITEM_PATTERN.match(block_text))
+        current_end = block["end_line"]
+        last_block = block_text
+
+    if current_lines:
+        segments.append("\n".join(current_lines))
+    return segments
+
+
+def render_markdown_segment_cached(segment_text, theme, code_theme, font_size, background, math_format="png", math_images="inline"):
+    """渲染单个顶层片段，按「片段哈希 + 渲染参数」复用结果。"""
+    cache_key = build_render_cache_key(segment_text, theme, code_theme, font_size, background, math_format, math_images)
+    return BLOCK_RENDER_CACHE.get_or_create(
+        cache_key,
+        lambda: render_markdown_fragment(
+            segment_text, theme, code_theme, font_size, background, math_format, math_images
+        ),
+        cacheable=is_render_cacheable
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def get_code_lexer(language, stripall=True):
+    """按语言别名缓存 Pygments lexer，未知别名返回 None。
+
+    stripall 去掉代码首尾空白；猜测出的语言与 guess_lexer 一致不去除，保留首行缩进。
+    """
+    try:
+        return get_lexer_by_name(language, stripall=stripall)
+    except ClassNotFound:
+        return None
+
+
+@functools.lru_cache(maxsize=32)
+def get_code_formatter(style_name):
+    """按代码主题缓存内联样式的 HtmlFormatter，避免每个代码块重新解析整套样式。"""
+    try:
+        style = get_style_by_name(style_name)
+    except ClassNotFound:
+        style = get_style_by_name('default')
+
+    return HtmlFormatter(
+        style=style,
+        nowrap=True,
+        noclasses=True,
+        prestyles='margin:0;padding:0;background:transparent;'
+    )
+
+
+def highlight_code(code, language, style_name):
+    """使用 Pygments 高亮代码，按「代码哈希 + 语言 + 样式」缓存结果"""
+    cache_key = build_render_cache_key(code, language, style_name)
+    return HIGHLIGHT_CACHE.get_or_create(cache_key, lambda: highlight_code_uncached(code, language, style_name))
+
+
+@functools.lru_cache(maxsize=1)
+def get_code_language_index():
+    """构建「小写别名/扩展名 -> lexer 主别名」索引，别名优先于扩展名。"""
+    lexers = [(aliases, filenames) for _, aliases, filenames, _ in get_all_lexers(plugins=False) if aliases]
+    index = {}
+    for aliases, _ in lexers:
+        for alias in aliases:
+            index.setdefault(alias.lower(), aliases[0])
+    for aliases, filenames in lexers:
+        for pattern in filenames:
+            extension = pattern[2:].lower() if pattern.startswith('*.') else ''
+            if extension and re.fullmatch(r'[\w+#-]+', extension):
+                index.setdefault(extension, aliases[0])
+    return MappingProxyType(index)
+
+
+def detect_code_language(code):
+    """用 Pygments 猜测代码语言，返回 (lexer 别名, 结果类型)。"""
+    try:
+        lexer = guess_lexer(code)
+    except ClassNotFound:
+        return 'text', 'detection_failed'
+    if not lexer.aliases:
+        return 'text', 'detection_failed'
+    return lexer.aliases[0], 'detected'
 
 
-def render_latex_local(latex_code, theme_config=None):
-    """使用 matplotlib 本地渲染简单的 LaTeX 公式"""
-    import matplotlib
-    matplotlib.use('Agg')
-    import matplotlib.pyplot as plt
-    from matplotlib import rcParams
+def resolve_code_language(code, language):
+    """确定代码块使用的 lexer 别名：先查别名索引，超长代码跳过猜测，猜测结果按代码哈希缓存。"""
+    alias = get_code_language_index().get((language or '').strip().lower())
+    if alias:
+        return alias, 'alias'
 
-    rcParams['mathtext.fontset'] = 'cm'
-    rcParams['font.family'] = 'serif'
+    if len(code) > CODE_LANGUAGE_DETECTION_MAX_CHARS:
+        return 'text', 'detection_skipped_too_large'
 
-    bg_color = '#ffffff'
-    text_color = '#333333'
+    cache_key = build_render_cache_key(code)
+    detected = LANGUAGE_DETECTION_CACHE.get(cache_key)
+    if detected is not None:
+        return detected, 'detection_cached'
+
+    detected, outcome = detect_code_language(code)
+    LANGUAGE_DETECTION_CACHE.set(cache_key, detected)
+    return detected, outcome
+
+
+def highlight_code_uncached(code, language, style_name):
+    """实际执行 Pygments 高亮。"""
+    alias, outcome = resolve_code_language(code, language)
+    increment_metric(f"highlight.language.{outcome}")
+
+    lexer = get_code_lexer(alias, stripall=outcome == 'alias')
+    if lexer is None:
+        increment_metric("highlight.language.lexer_missing")
+        lexer = get_code_lexer('text')
+
+    return highlight(code, lexer, get_code_formatter(style_name))
+
+
+def get_formula_colors(theme_config=None):
+    """返回公式渲染使用的 (背景色, 文字颜色, 是否深色背景)，颜色不带 #。"""
+    # 获取主题背景色和文字颜色
+    bg_color = 'FFFFFF'
+    text_color = '000000'
     if theme_config and 'styles' in theme_config:
-        bg_color = theme_config['styles'].get('bg_color', '#ffffff')
-        text_color = theme_config['styles'].get('text_color', '#333333')
+        bg = theme_config['styles'].get('bg_color', '#ffffff')
+        txt = theme_config['styles'].get('text_color', '#333333')
+        bg_color = bg.lstrip('#')
+        text_color = txt.lstrip('#')
+
+    # 判断是否为深色背景
+    # 计算背景亮度
+    try:
+        r, g, b = int(bg_color[0:2], 16), int(bg_color[2:4], 16), int(bg_color[4:6], 16)
+    except ValueError:
+        return bg_color, text_color, False
+    return bg_color, text_color, (r * 0.299 + g * 0.587 + b * 0.114) < 128
 
-    fig, ax = plt.subplots(figsize=(10, 0.8))
-    fig.patch.set_facecolor(bg_color)
-    ax.set_facecolor(bg_color)
-    ax.axis('off')
 
-    ax.text(0.5, 0.5, f'${latex_code}$',
-            transform=ax.transAxes,
-            fontsize=16,
-            ha='center',
-            va='center',
-            color=text_color)
+def normalize_math_format(value):
+    """校验公式图片格式，非法值回退为 png。"""
+    value = str(value or "png").strip().lower()
+    return value if value in MATH_FORMATS else "png"
 
-    fig.tight_layout(pad=0.5)
 
-    buffer = io.BytesIO()
-    fig.savefig(buffer, format='png', dpi=150,
-                facecolor=bg_color, edgecolor='none',
-                bbox_inches='tight', pad_inches=0.1)
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.read()).decode('utf-8')
-    plt.close(fig)
+def normalize_math_images(value):
+    """校验公式图片引用方式，非法值回退为 inline。"""
+    value = str(value or "inline").strip().lower()
+    return value if value in MATH_IMAGE_MODES else "inline"
+
+
+def build_formula_cache_key(latex_code, theme_config=None):
+    """返回公式的内容哈希，由「公式 + 颜色 + 深色标记 + dpi」决定，PNG 和 SVG 共用。"""
+    bg_color, text_color, is_dark = get_formula_colors(theme_config)
+    return build_render_cache_key(latex_code, bg_color, text_color, int(is_dark), FORMULA_RENDER_DPI)
+
+
+def render_latex_bytes(latex_code, theme_config=None, image_format="png"):
+    """将 LaTeX 公式渲染为图片字节，按公式哈希和图片格式缓存到磁盘"""
+    _, _, is_dark = get_formula_colors(theme_config)
+    cache_key = build_formula_cache_key(latex_code, theme_config)
+    suffix = f".{image_format}"
+
+    img_data = FORMULA_CACHE.get(cache_key, suffix)
+    if img_data is None:
+        img_data = render_latex_image(latex_code, theme_config, is_dark, image_format)
+        if img_data is None:
+            return None
+        FORMULA_CACHE.set(cache_key, suffix, img_data)
+    return img_data
 
+
+def render_latex_to_data_url(latex_code, theme_config=None, image_format="png"):
+    """将 LaTeX 公式渲染为内联的 data URL，渲染失败返回 None"""
+    img_data = render_latex_bytes(latex_code, theme_config, image_format)
+    if img_data is None:
+        return None
+    return build_image_data_url(img_data, image_format)
+
+
+def render_latex_to_hosted_url(latex_code, theme_config=None, image_format="png"):
+    """将 LaTeX 公式渲染后保存到分享图片目录，返回站内图片路径；目录不可写时退回 data URL"""
+    img_data = render_latex_bytes(latex_code, theme_config, image_format)
+    if img_data is None:
+        return None
+    try:
+        filename = save_formula_image_bytes(img_data, image_format)
+    except OSError as exc:
+        app.logger.warning("Unable to host formula image: %s", exc)
+        return build_image_data_url(img_data, image_format)
+    return build_share_image_path(filename)
+
+
+def build_deferred_formula_url(latex_code, theme_config=None, image_format="png"):
+    """不渲染公式，只记录公式内容并返回 /api/math 的图片地址；磁盘缓存关闭时退回内联渲染"""
+    if not FORMULA_SPEC_CACHE.enabled:
+        return render_latex_to_data_url(latex_code, theme_config, image_format)
+
+    cache_key = build_formula_cache_key(latex_code, theme_config)
+    # 公式内容写入各 worker 共享的磁盘目录，图片请求落到任意 worker 都能渲染
+    if not FORMULA_SPEC_CACHE.contains(cache_key, ".json"):
+        bg_color, text_color, _ = get_formula_colors(theme_config)
+        spec = {"latex": latex_code, "bg_color": bg_color, "text_color": text_color}
+        FORMULA_SPEC_CACHE.set(cache_key, ".json", json.dumps(spec, ensure_ascii=False).encode("utf-8"))
+    return f"/api/math/{cache_key}.{image_format}"
+
+
+def render_deferred_formula(cache_key, image_format):
+    """按公式哈希渲染延迟加载的公式，找不到公式记录或渲染失败返回 None"""
+    img_data = FORMULA_CACHE.get(cache_key, f".{image_format}")
+    if img_data is not None:
+        return img_data
+
+    # 旧版本把公式内容和图片写在同一目录，找不到时再到图片缓存中查一次
+    spec_data = FORMULA_SPEC_CACHE.get(cache_key, ".json") or FORMULA_CACHE.get(cache_key, ".json")
+    if spec_data is None:
+        return None
+    spec = json.loads(spec_data)
+    theme_config = {"styles": {"bg_color": f"#{spec['bg_color']}", "text_color": f"#{spec['text_color']}"}}
+    return render_latex_bytes(spec["latex"], theme_config, image_format)
+
+
+def build_image_data_url(img_data, image_format="png"):
+    """PNG 使用 base64；SVG 是文本，只转义必要字符，体积比 base64 小且仍可被 gzip 压缩"""
+    if image_format == "svg":
+        svg = img_data.decode('utf-8').replace('"', "'")
+        return "data:image/svg+xml," + urllib.parse.quote(svg, safe=" '=:;,/?()+-.*_!~$&@")
+    img_base64 = base64.b64encode(img_data).decode('utf-8')
     return f'data:image/png;base64,{img_base64}'
 
 
-def process_math_formulas(md_text, theme_config=None):
-    """处理 Markdown 中的数学公式"""
+SVG_STRIP_PATTERN = re.compile(
+    r'<\?xml.*?\?>|<!DOCTYPE.*?>|<metadata>.*?</metadata>|<!--.*?-->|<g id="patch_1">.*?</g>',
+    re.DOTALL
+)
+SVG_PATH_DATA_PATTERN = re.compile(r' d="([^"]*)"')
+SVG_SIZE_PATTERN = re.compile(r'(<svg\b[^>]*?\b(?:width|height)=")([\d.]+)pt"')
 
-    # 处理块级公式 $$...$$
-    def replace_block_math(match):
-        latex = match.group(1).strip()
-        img_src = render_latex_to_base64(latex, theme_config)
-        if img_src:
-            return f'\n<img src="{img_src}" style="display: block; margin: 16px auto; max-width: 100%;" alt="math">\n'
-        return f'<div style="text-align: center; margin: 16px 0; padding: 12px; background: #f5f5f5; border-radius: 4px;"><code>{latex}</code></div>'
 
-    md_text = re.sub(r'\$\$(.+?)\$\$', replace_block_math, md_text, flags=re.DOTALL)
+def minify_svg(svg_data, dpi=FORMULA_RENDER_DPI):
+    """精简 matplotlib 输出的 SVG：去掉 XML 声明、元数据、注释和透明背景，压缩空白和路径数据。
 
-    # 处理行内/块级公式 $...$（支持多行）
-    def replace_inline_math(match):
-        latex = match.group(1).strip()
-        img_src = render_latex_to_base64(latex, theme_config)
-        if img_src:
-            # 判断是否为多行公式（包含换行符）
-            if '\n' in latex:
-                return f'\n<img src="{img_src}" style="display: block; margin: 16px auto; max-width: 100%;" alt="math">\n'
-            return f'<img src="{img_src}" style="display: inline-block; vertical-align: middle; margin: 0 2px; max-height: 1.5em;" alt="math">'
-        return f'<code style="background: #f5f5f5; padding: 2px 4px; border-radius: 2px;">{latex}</code>'
+    宽高从 pt 换算为与同 dpi 的 PNG 相同的像素尺寸，切换格式时公式显示大小不变。
+    """
+    svg = SVG_STRIP_PATTERN.sub('', svg_data.decode('utf-8'))
+    svg = re.sub(r'>\s+<', '><', svg.strip())
+    svg = SVG_PATH_DATA_PATTERN.sub(
+        lambda m: ' d="' + re.sub(r'\s*([MLQCZz])\s*', r'\1', ' '.join(m.group(1).split())) + '"',
+        svg
+    )
+    while True:
+        resized = SVG_SIZE_PATTERN.sub(lambda m: f'{m.group(1)}{float(m.group(2)) * dpi / 72:g}"', svg, count=1)
+        if resized == svg:
+            break
+        svg = resized
+    return svg.encode('utf-8')
 
-    # 匹配单个 $ 的公式，支持多行内容
-    # 使用更精确的模式：$ 开头，$ 结尾，中间可以包含任何字符（包括换行）
-    md_text = re.sub(r'(?<!\$)\$(?!\$)([\s\S]+?)(?<!\$)\$(?!\$)', replace_inline_math, md_text)
 
-    return md_text
+def render_latex_image(latex_code, theme_config=None, is_dark=False, image_format="png"):
+    """按 MATH_RENDER_ENGINE 依次尝试本地 mathtext 和在线服务渲染公式图片，都失败返回 None。
 
+    local：本地优先，mathtext 不支持的语法再请求在线服务；remote：在线优先，失败时本地兜底；
+    offline：只使用本地渲染，适合无法访问外网的部署。
+    """
+    renderers = {
+        "local": (("local", render_latex_local), ("remote", render_latex_remote)),
+        "remote": (("remote", render_latex_remote), ("local", render_latex_local)),
+        "offline": (("local", render_latex_local),)
+    }[MATH_RENDER_ENGINE]
+
+    for name, renderer in renderers:
+        # 在线服务熔断期间直接跳过，不再等待请求超时
+        if name == "remote" and not REMOTE_MATH_BREAKER.allow_request():
+            increment_metric("formula.render.remote.short_circuited")
+            continue
+        try:
+            img_data = renderer(latex_code, theme_config, is_dark, image_format)
+        except Exception as e:
+            increment_metric(f"formula.render.{name}.failed")
+            app.logger.info("%s LaTeX render failed: %s", name.capitalize(), e)
+            if name == "remote":
+                REMOTE_MATH_BREAKER.record_failure(e)
+            continue
+        if name == "remote":
+            REMOTE_MATH_BREAKER.record_success()
+        increment_metric(f"formula.render.{name}.ok")
+        return img_data
+    return None
 
 
-def process_markdown(md_text, theme="default", code_theme="github", font_size="medium", background="warm"):
-    """处理Markdown文本，生成微信兼容的HTML"""
+def render_latex_remote(latex_code, theme_config=None, is_dark=False, image_format="png"):
+    """使用 CodeCogs 在线 LaTeX 渲染服务，返回 PNG 或 SVG 字节"""
+    # 对于深色背景，使用白色文字
+    if is_dark:
+        latex_code = f"\\color{{white}}{{{latex_code}}}"
 
-    # 获取主题配置
-    theme_config = THEMES.get(theme, THEMES["default"])
-    font_config = FONT_SIZES.get(font_size, FONT_SIZES["medium"])
-    bg_config = BACKGROUNDS.get(background, BACKGROUNDS["warm"])
-    code_theme_config = CODE_THEMES.get(code_theme, CODE_THEMES["github"])
+    encoded_latex = urllib.parse.quote(latex_code)
+    if image_format == "svg":
+        url = f"https://latex.codecogs.com/svg.latex?{encoded_latex}"
+    else:
+        url = f"https://latex.codecogs.com/png.latex?\\dpi{{{FORMULA_RENDER_DPI}}}{encoded_latex}"
+
+    # 获取图片
+    req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+    with urllib.request.urlopen(req, timeout=REMOTE_MATH_TIMEOUT_SECONDS) as response:
+        img_data = response.read()
+    return minify_svg(img_data) if image_format == "svg" else img_data
+
+
+# 每个 worker 进程内的所有请求线程共享同一个熔断器
+REMOTE_MATH_BREAKER = CircuitBreaker(
+    "math_remote",
+    REMOTE_MATH_FAILURE_THRESHOLD,
+    REMOTE_MATH_PROBE_INTERVAL_SECONDS,
+    probe=lambda: render_latex_remote("x")
+)
+
+
+_MATPLOTLIB_LOCK = threading.Lock()
+_MATH_RENDER_POOL = None
+_MATH_RENDER_POOL_LOCK = threading.Lock()
+
+
+def render_mathtext_image(latex_code, text_color, image_format="png", dpi=FORMULA_RENDER_DPI):
+    """用 matplotlib mathtext 的面向对象接口（Figure + Agg）渲染公式，不经过 pyplot 和全局 rcParams。"""
+    from matplotlib.figure import Figure
+    from matplotlib.font_manager import FontProperties
+    from matplotlib.mathtext import MathTextParser
+
+    expression = f'${latex_code}$'
+    prop = FontProperties(size=MATHTEXT_FONT_SIZE, math_fontfamily='cm')
+    width, height, depth, _, _ = MathTextParser('path').parse(expression, dpi=72, prop=prop)
+
+    # 四周留 2pt 空白，避免上下标贴边被裁切
+    padding = 2
+    figure_width = width + padding * 2
+    figure_height = height + padding * 2
+    fig = Figure(figsize=(figure_width / 72, figure_height / 72))
+    fig.text(
+        padding / figure_width,
+        (padding + depth) / figure_height,
+        expression,
+        fontproperties=prop,
+        color=text_color
+    )
+
+    buffer = io.BytesIO()
+    if image_format == "svg":
+        # SVG 字形以路径输出，不依赖读者设备上的字体；去掉日期元数据保证相同公式输出一致
+        fig.savefig(buffer, format="svg", transparent=True, metadata={'Date': None})
+        return minify_svg(buffer.getvalue(), dpi)
+    fig.savefig(buffer, dpi=dpi, format=image_format, transparent=True)
+    return buffer.getvalue()
+
+
+def warm_math_render_worker():
+    """公式渲染子进程启动时预先加载 matplotlib 和数学字体。"""
+    render_mathtext_image('x^2', '#333333')
+
+
+def get_math_render_pool():
+    """懒加载常驻的公式渲染进程池；已在子进程中（如批量渲染进程）或未启用时返回 None，在当前进程内渲染。"""
+    global _MATH_RENDER_POOL
+    if MATH_RENDER_WORKERS <= 0 or multiprocessing.parent_process() is not None:
+        return None
+
+    with _MATH_RENDER_POOL_LOCK:
+        if _MATH_RENDER_POOL is None:
+            _MATH_RENDER_POOL = ProcessPoolExecutor(
+                max_workers=MATH_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=warm_math_render_worker
+            )
+        return _MATH_RENDER_POOL
+
+
+def reset_math_render_pool(pool):
+    """渲染子进程异常退出后丢弃进程池，下次渲染时重新创建。"""
+    global _MATH_RENDER_POOL
+    with _MATH_RENDER_POOL_LOCK:
+        if _MATH_RENDER_POOL is pool:
+            _MATH_RENDER_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def render_latex_local(latex_code, theme_config=None, is_dark=False, image_format="png"):
+    """使用 matplotlib mathtext 本地渲染公式，返回 PNG 或 SVG 字节；默认在常驻进程池中执行"""
+    _, text_color, _ = get_formula_colors(theme_config)
+    text_color = f'#{text_color}'
+
+    pool = get_math_render_pool()
+    if pool is None:
+        # matplotlib 的字体缓存不是线程安全的，进程内渲染需要串行
+        with _MATPLOTLIB_LOCK:
+            return render_mathtext_image(latex_code, text_color, image_format)
+
+    try:
+        return pool.submit(render_mathtext_image, latex_code, text_color, image_format).result(
+            timeout=MATH_RENDER_TIMEOUT_SECONDS
+        )
+    except BrokenProcessPool:
+        reset_math_render_pool(pool)
+        raise
+
+
+# 与 parse_markdown_document 提取代码块使用同一个模式，保证公式扫描跳过的范围与代码块一致
+FENCED_CODE_PATTERN = re.compile(r'```(\w*)\s*\n(.*?)\n```', re.DOTALL)
+# 行内代码扫描的记号：转义字符、反引号串、段落分隔（行内代码不跨段落）
+INLINE_CODE_TOKEN_PATTERN = re.compile(r'\\.|`+|\n[ \t]*\n')
+# 行内公式的定界符：前后都不是 $ 的单个 $
+# 行内公式分隔符：前后不紧邻 $，且没有用反斜杠转义
+MATH_INLINE_DELIMITER_PATTERN = re.compile(r'(?<![\\$])\$(?!\$)')
+# 任意公式分隔符：$$ 或未转义的单个 $
+MATH_DELIMITER_PATTERN = re.compile(r'\$\$|(?<![\\$])\$(?!\$)')
+# 公式占位符使用与渲染结果相同的 <img> 形态，Markdown 对它的解析方式与对公式图片完全一致
+MATH_PLACEHOLDER_PATTERN = re.compile(r'<img data-md2-math="(\d+)">|&lt;img data-md2-math="(\d+)"&gt;')
+
+
+def iter_inline_code_spans(md_text, start, end):
+    """把 [start, end) 切分为 (起点, 终点, 是否行内代码)，按 Python-Markdown 的规则配对等长反引号串。
+
+    先为每个反引号串预先算出同段落内下一个等长反引号串，再顺序配对，整体为线性时间。
+    """
+    runs = []
+    paragraph = 0
+    for token in INLINE_CODE_TOKEN_PATTERN.finditer(md_text, start, end):
+        text = token.group(0)
+        if text[0] == '`':
+            runs.append((token.start(), token.end(), len(text), paragraph))
+        elif text[0] == '\n':
+            paragraph += 1
+
+    next_closing = [None] * len(runs)
+    latest = {}
+    for index in range(len(runs) - 1, -1, -1):
+        key = runs[index][2:]
+        next_closing[index] = latest.get(key)
+        latest[key] = index
+
+    position = start
+    index = 0
+    while index < len(runs):
+        closing = next_closing[index]
+        if closing is None:
+            index += 1
+            continue
+        yield position, runs[index][0], False
+        yield runs[index][0], runs[closing][1], True
+        position = runs[closing][1]
+        index = closing + 1
+    yield position, end, False
+
+
+def iter_markdown_code_spans(md_text):
+    """按顺序把 Markdown 切分为 (起点, 终点, 是否代码)，代码包括围栏代码块和行内代码。"""
+    position = 0
+    for fence in FENCED_CODE_PATTERN.finditer(md_text):
+        yield from iter_inline_code_spans(md_text, position, fence.start())
+        yield fence.start(), fence.end(), True
+        position = fence.end()
+    yield from iter_inline_code_spans(md_text, position, len(md_text))
 
-    # 处理数学公式（在代码块处理之前）
-    md_text = process_math_formulas(md_text, theme_config)
+
+def extract_math_formulas(md_text):
+    """把 Markdown 正文中的数学公式替换为占位符，返回 (新文本, [(latex, 类型, 原文)])。
+
+    围栏代码块和行内代码原样保留，其中的 $ 不会被当作公式。正文中先配对 $$...$$，再配对前后不紧邻 $ 的单个 $，
+    配对结果与逐个正则替换一致，但每段正文只顺序扫描一遍，大量不成对的 $ 也保持线性时间。
+    块级公式占位符两侧保留换行，与渲染成功时插入的块级图片结构一致，保证 Markdown 解析结果不随主题变化。
+    """
+    formulas = []
+
+    def save_formula(source, latex, kind):
+        placeholder = f'<img data-md2-math="{len(formulas)}">'
+        latex = latex.strip()
+        formulas.append((latex, kind, source))
+        if kind == 'block' or '\n' in latex:
+            return f'\n{placeholder}\n'
+        return placeholder
+
+    def replace_block_formulas(text):
+        parts = []
+        position = 0
+        while True:
+            opening = text.find('$$', position)
+            if opening < 0:
+                break
+            # 公式内容至少一个字符
+            closing = text.find('$$', opening + 3)
+            if closing < 0:
+                break
+            parts.append(text[position:opening])
+            parts.append(save_formula(text[opening:closing + 2], text[opening + 2:closing], 'block'))
+            position = closing + 2
+        parts.append(text[position:])
+        return ''.join(parts)
+
+    def replace_inline_formulas(text):
+        delimiters = [match.start() for match in MATH_INLINE_DELIMITER_PATTERN.finditer(text)]
+        parts = []
+        position = 0
+        for opening, closing in zip(delimiters[0::2], delimiters[1::2]):
+            parts.append(text[position:opening])
+            parts.append(save_formula(text[opening:closing + 1], text[opening + 1:closing], 'inline'))
+            position = closing + 1
+        parts.append(text[position:])
+        return ''.join(parts)
+
+    parts = []
+    for start, end, is_code in iter_markdown_code_spans(md_text):
+        segment = md_text[start:end]
+        if not is_code and '$' in segment:
+            # 先处理块级公式 $$...$$，再处理行内/块级公式 $...$（支持多行）
+            segment = replace_inline_formulas(replace_block_formulas(segment))
+        parts.append(segment)
+    return ''.join(parts), formulas
+
+
+def restore_math_sources(text, formulas, escape=False):
+    """把文本中的公式占位符还原为公式原文，用于代码块、行内代码等不应渲染公式的位置。"""
+    if 'data-md2-math' not in text:
+        return text
+
+    def replace_formula(match):
+        source = formulas[int(match.group(1) or match.group(2))][2]
+        return html_lib.escape(source, quote=False) if escape else source
+
+    return MATH_PLACEHOLDER_PATTERN.sub(replace_formula, text)
+
+
+_FORMULA_RENDER_POOL = None
+_FORMULA_RENDER_POOL_LOCK = threading.Lock()
+
+
+def get_formula_render_pool():
+    """懒加载公式渲染线程池，进程内所有请求共用，限制同时进行的远程/本地渲染数量。"""
+    global _FORMULA_RENDER_POOL
+    with _FORMULA_RENDER_POOL_LOCK:
+        if _FORMULA_RENDER_POOL is None:
+            _FORMULA_RENDER_POOL = ThreadPoolExecutor(
+                max_workers=max(1, FORMULA_RENDER_CONCURRENCY),
+                thread_name_prefix="formula-render"
+            )
+        return _FORMULA_RENDER_POOL
+
+
+def render_math_formula_images(latex_codes, theme_config=None, image_format="png", math_images="inline"):
+    """并发渲染一组公式，相同公式只渲染一次；返回 {latex: 图片地址或 None}。
+
+    math_images 为 inline 时返回 data URL，为 hosted 时返回分享图片目录中按内容哈希命名的图片路径，
+    为 deferred 时不渲染，直接返回 /api/math 的延迟加载地址。
+    """
+    unique_latex_codes = list(dict.fromkeys(latex_codes))
+    if math_images == "deferred":
+        return {latex: build_deferred_formula_url(latex, theme_config, image_format) for latex in unique_latex_codes}
+
+    render = render_latex_to_hosted_url if math_images == "hosted" else render_latex_to_data_url
+    if len(unique_latex_codes) <= 1 or FORMULA_RENDER_CONCURRENCY <= 1:
+        return {latex: render(latex, theme_config, image_format) for latex in unique_latex_codes}
+
+    pool = get_formula_render_pool()
+    futures = {
+        latex: pool.submit(render, latex, theme_config, image_format)
+        for latex in unique_latex_codes
+    }
+    return {latex: future.result() for latex, future in futures.items()}
+
+
+# 公式渲染失败退回代码样式时带上的标记，含该标记的渲染结果不写入缓存，下次请求重新渲染
+MATH_RENDER_ERROR_ATTR = 'data-math-error="true"'
+
+
+def is_render_cacheable(html):
+    """渲染结果中没有失败的公式时才可以缓存。"""
+    return MATH_RENDER_ERROR_ATTR not in html
+
+
+def render_math_formula_html(latex, kind, img_src, image_format="png", deferred=False):
+    """生成单个公式的 HTML，用 data-math-format 记录图片格式；渲染失败（img_src 为空）时退回代码样式。
+
+    deferred 时图片地址写在 data-math-src 中，由前端在正文显示后再加载；公式原文和类型写在 data-math-latex、
+    data-math-kind 中，图片加载失败时前端据此退回同样的代码样式。
+    """
+    if img_src:
+        src_attr = "data-math-src" if deferred else "src"
+        if deferred:
+            src_attr = f'data-math-latex="{html_lib.escape(latex)}" data-math-kind="{kind}" {src_attr}'
+        # 块级公式和多行行内公式独占一行
+        if kind == 'block' or '\n' in latex:
+            return f'<img {src_attr}="{img_src}" data-math-format="{image_format}" style="display: block; margin: 16px auto; max-width: 100%;" alt="math">'
+        return f'<img {src_attr}="{img_src}" data-math-format="{image_format}" style="display: inline-block; vertical-align: middle; margin: 0 2px; max-height: 1.5em;" alt="math">'
+    if kind == 'block':
+        return f'<div style="text-align: center; margin: 16px 0; padding: 12px; background: #f5f5f5; border-radius: 4px;"><code {MATH_RENDER_ERROR_ATTR}>{latex}</code></div>'
+    return f'<code {MATH_RENDER_ERROR_ATTR} style="background: #f5f5f5; padding: 2px 4px; border-radius: 2px;">{latex}</code>'
+
+
+MARKDOWN_EXTENSIONS = ('tables', 'nl2br', 'sane_lists')
+_MARKDOWN_CONVERTERS = threading.local()
+
+
+def get_markdown_converter():
+    """返回当前线程复用的 Markdown 转换器，使用前 reset() 清理上次转换的状态。
+
+    markdown.Markdown 实例不是线程安全的，gunicorn gthread 模式下每个线程各持有一个。
+    """
+    converter = getattr(_MARKDOWN_CONVERTERS, "converter", None)
+    if converter is None:
+        converter = markdown.Markdown(extensions=list(MARKDOWN_EXTENSIONS))
+        _MARKDOWN_CONVERTERS.converter = converter
+    else:
+        converter.reset()
+    return converter
+
+
+RENDER_PLACEHOLDER_PATTERN = re.compile(
+    r'<p>((?:CODEBLOCK|MERMAID|SLIDER)PLACEHOLDER\d+ENDPLACEHOLDER)</p>'
+    r'|((?:CODEBLOCK|MERMAID|SLIDER)PLACEHOLDER\d+ENDPLACEHOLDER|<img data-md2-math="\d+">)'
+)
+
+
+def restore_render_placeholders(html_content, placeholder_html):
+    """单次扫描还原代码块、Mermaid、幻灯片（含被 <p> 包裹的形式）与公式占位符，未知占位符原样保留。"""
+    if not placeholder_html or ('ENDPLACEHOLDER' not in html_content and 'data-md2-math' not in html_content):
+        return html_content
+
+    def replace_placeholder(match):
+        return placeholder_html.get(match.group(1) or match.group(2), match.group(0))
+
+    return RENDER_PLACEHOLDER_PATTERN.sub(replace_placeholder, html_content)
+
+
+def process_markdown(md_text, theme="default", code_theme="github", font_size="medium", background="warm", incremental=False, math_format="png", math_images="inline"):
+    """处理Markdown文本，生成微信兼容的HTML；incremental=True 时按块渲染并复用未变化块的结果"""
+    if incremental:
+        segments = split_markdown_render_segments(md_text)
+        styled_content = "\n".join(
+            render_markdown_segment_cached(segment, theme, code_theme, font_size, background, math_format, math_images)
+            for segment in segments
+        )
+    else:
+        styled_content = render_markdown_fragment(
+            md_text, theme, code_theme, font_size, background, math_format, math_images
+        )
+
+    return wrap_styled_html(styled_content, get_render_stylesheet(theme, code_theme, font_size, background))
+
+
+def render_markdown_fragment(md_text, theme="default", code_theme="github", font_size="medium", background="warm", math_format="png", math_images="inline"):
+    """渲染 Markdown 为带内联样式的内容片段，不含外层 section。"""
+    return render_parsed_markdown(
+        parse_markdown_document(md_text), theme, code_theme, font_size, background, math_format, math_images
+    )
+
+
+INLINE_CODE_HTML_PATTERN = re.compile(r'<code>(.*?)</code>', re.DOTALL)
+
+
+def parse_markdown_document(md_text):
+    """与主题无关的解析阶段：提取公式、幻灯片和代码块并解析 Markdown，结果可在多个主题间复用。"""
+
+    # 提取数学公式（在代码块处理之前，跳过代码块和行内代码）
+    md_text, math_formulas = extract_math_formulas(md_text)
 
     # 提取并临时替换横屏滑动幻灯片（在代码块处理之前）
     sliders = []
 
     def save_slider(match):
         placeholder = f'SLIDERPLACEHOLDER{len(sliders)}ENDPLACEHOLDER'
-        sliders.append(match.group(1))
+        sliders.append(restore_math_sources(match.group(1), math_formulas))
         return placeholder
 
     slider_pattern = r'<(!.+?)>'
@@ -3201,7 +5294,8 @@ def process_markdown(md_text, theme="default", code_theme="github", font_size="m
 
     def save_code_block(match):
         lang = (match.group(1) or '').strip()
-        code = match.group(2)
+        # 代码中的 $...$ 不渲染为公式，保留原文
+        code = restore_math_sources(match.group(2), math_formulas)
         if lang.lower() == 'mermaid':
             placeholder = f'MERMAIDPLACEHOLDER{len(mermaid_blocks)}ENDPLACEHOLDER'
             mermaid_blocks.append(code.strip())
@@ -3212,53 +5306,65 @@ def process_markdown(md_text, theme="default", code_theme="github", font_size="m
         return placeholder
 
     # 匹配 fenced code blocks - 更宽松的匹配
-    pattern = r'```(\w*)\s*\n(.*?)\n```'
-    md_text_processed = re.sub(pattern, save_code_block, md_text, flags=re.DOTALL)
+    md_text_processed = FENCED_CODE_PATTERN.sub(save_code_block, md_text)
 
     # 解析 Markdown（不含代码块）
-    md = markdown.Markdown(extensions=[
-        'tables',
-        'nl2br',
-        'sane_lists'
-    ])
-    html_content = md.convert(md_text_processed)
+    html_content = get_markdown_converter().convert(md_text_processed)
+    if math_formulas:
+        html_content = INLINE_CODE_HTML_PATTERN.sub(
+            lambda match: f'<code>{restore_math_sources(match.group(1), math_formulas, escape=True)}</code>',
+            html_content
+        )
 
-    # 恢复并高亮代码块
-    for i, (lang, code) in enumerate(code_blocks):
-        placeholder = f'CODEBLOCKPLACEHOLDER{i}ENDPLACEHOLDER'
-        if lang:
-            highlighted = highlight_code(code, lang, code_theme_config["style"])
-        else:
-            highlighted = highlight_code(code, 'text', code_theme_config["style"])
+    return {
+        "html": html_content,
+        "math_formulas": math_formulas,
+        "sliders": sliders,
+        "code_blocks": code_blocks,
+        "mermaid_blocks": mermaid_blocks
+    }
 
-        # 包装为 pre/code 结构
-        code_html = f'<pre class="code-block" data-lang="{lang}"><code>{highlighted}</code></pre>'
 
-        # 尝试多种替换方式
-        html_content = html_content.replace(f'<p>{placeholder}</p>', code_html)
-        html_content = html_content.replace(placeholder, code_html)
+def render_parsed_markdown(parsed, theme="default", code_theme="github", font_size="medium", background="warm", math_format="png", math_images="inline"):
+    """按主题渲染 parse_markdown_document 的结果：渲染公式、高亮代码、还原占位符并补充内联样式。"""
 
-    # 恢复 Mermaid 图表占位，交由前端渲染为 SVG
-    mermaid_bg = theme_config['styles'].get('blockquote_bg', '#f8f9fa')
-    mermaid_text = theme_config['styles'].get('secondary_text', '#666666')
-    mermaid_border = theme_config['colors'][1]
-    mermaid_radius = theme_config['styles'].get('border_radius', '8px')
-    mermaid_border_rgba = mermaid_border if mermaid_border.startswith('rgba') else f"rgba({int(mermaid_border[1:3], 16)}, {int(mermaid_border[3:5], 16)}, {int(mermaid_border[5:7], 16)}, 0.22)"
+    # 获取主题配置
+    theme_config = THEMES.get(theme, THEMES["default"])
+    font_config = FONT_SIZES.get(font_size, FONT_SIZES["medium"])
+    bg_config = BACKGROUNDS.get(background, BACKGROUNDS["warm"])
+    code_theme_config = CODE_THEMES.get(code_theme, CODE_THEMES["github"])
+    stylesheet = get_render_stylesheet(theme, code_theme, font_size, background)
+    html_content = parsed["html"]
+    mermaid_blocks = parsed["mermaid_blocks"]
+    sliders = parsed["sliders"]
+    code_blocks = parsed["code_blocks"]
+
+    # 占位符 -> 还原后的 HTML，最后单次扫描统一替换
+    placeholder_html = {}
+
+    # 渲染数学公式（公式颜色随主题变化）：先收集去重，再并发渲染
+    math_formulas = parsed["math_formulas"]
+    if math_formulas:
+        formula_images = render_math_formula_images(
+            [latex for latex, _, _ in math_formulas], theme_config, math_format, math_images
+        )
+        for i, (latex, kind, _) in enumerate(math_formulas):
+            placeholder_html[f'<img data-md2-math="{i}">'] = render_math_formula_html(
+                latex, kind, formula_images[latex], math_format, deferred=math_images == "deferred"
+            )
 
+    # 恢复 Mermaid 图表占位，交由前端渲染为 SVG
     for i, code in enumerate(mermaid_blocks):
         placeholder = f'MERMAIDPLACEHOLDER{i}ENDPLACEHOLDER'
         encoded = base64.b64encode(code.encode('utf-8')).decode('utf-8')
-        mermaid_html = (
+        placeholder_html[placeholder] = (
             f'<div class="md2-mermaid" data-mermaid="{encoded}" '
-            f'style="margin: 18px 0; padding: 16px; border: 1px dashed {mermaid_border_rgba}; '
-            f'border-radius: {mermaid_radius}; background: {mermaid_bg}; overflow-x: auto;">'
-            f'<div class="md2-mermaid-status" style="font-size: 12px; color: {mermaid_text};">'
+            f'style="{stylesheet["mermaid_container"]}">'
+            f'<div class="md2-mermaid-status" style="{stylesheet["mermaid_status"]}">'
             'Mermaid 图表渲染中...</div></div>'
         )
-        html_content = html_content.replace(f'<p>{placeholder}</p>', mermaid_html)
-        html_content = html_content.replace(placeholder, mermaid_html)
 
-    # 恢复横屏滑动幻灯片（在代码块之后，generate_styled_html 之前）
+    # 恢复横屏滑动幻灯片（generate_styled_html 之前）
     for i, slider_content in enumerate(sliders):
         placeholder = f'SLIDERPLACEHOLDER{i}ENDPLACEHOLDER'
         # 解析幻灯片中的图片
@@ -3267,7 +5373,7 @@ def process_markdown(md_text, theme="default", code_theme="github", font_size="m
 
         if images:
             # 获取主题边框圆角
-            border_radius = theme_config['styles'].get('border_radius', '6px')
+            border_radius = stylesheet["border_radius"]
 
             # 生成横屏滑动幻灯片 HTML - 每张图片 16:9 宽高比，拉伸填充，每张占满容器宽度
             images_html = []
@@ -3278,9 +5384,21 @@ def process_markdown(md_text, theme="default", code_theme="github", font_size="m
                 images_html.append(img_html)
 
             slider_html = f'<section style="width: 100%; overflow-x: auto; -webkit-overflow-scrolling: touch; margin: 16px 0; scroll-snap-type: x mandatory; border-radius: {border_radius};"><div style="display: flex;">{"".join(images_html)}</div></section>'
+            placeholder_html[placeholder] = slider_html
+
+    # 恢复并高亮代码块
+    for i, (lang, code) in enumerate(code_blocks):
+        placeholder = f'CODEBLOCKPLACEHOLDER{i}ENDPLACEHOLDER'
+        if lang:
+            highlighted = highlight_code(code, lang, code_theme_config["style"])
+        else:
+            highlighted = highlight_code(code, 'text', code_theme_config["style"])
+
+        # 包装为 pre/code 结构；代码中的 <!...> 在提取代码块之前已被替换为幻灯片占位符，需要一并还原
+        code_html = f'<pre class="code-block" data-lang="{lang}"><code>{highlighted}</code></pre>'
+        placeholder_html[placeholder] = restore_render_placeholders(code_html, placeholder_html)
 
-            html_content = html_content.replace(f'<p>{placeholder}</p>', slider_html)
-            html_content = html_content.replace(placeholder, slider_html)
+    html_content = restore_render_placeholders(html_content, placeholder_html)
 
     # 生成内联样式的HTML
     styled_html = generate_styled_html(
@@ -3288,19 +5406,20 @@ def process_markdown(md_text, theme="default", code_theme="github", font_size="m
         theme_config,
         code_theme_config,
         font_config,
-        bg_config
+        bg_config,
+        include_wrapper=False,
+        stylesheet=stylesheet
     )
 
     return styled_html
 
 
-def generate_styled_html(content, theme_config, code_theme, font_config, bg_config):
-    """生成带内联样式的HTML，确保微信兼容"""
+def build_render_stylesheet(theme_config, code_theme, font_config, bg_config):
+    """预先计算一组主题配置下的全部内联样式字符串，返回只读映射。"""
 
     primary_color = theme_config["colors"][0]
     secondary_color = theme_config["colors"][1]
     accent_color = theme_config["colors"][2]
-    base_font = font_config["base"]
 
     # 获取主题样式配置
     styles = theme_config.get("styles", {
@@ -3326,14 +5445,8 @@ def generate_styled_html(content, theme_config, code_theme, font_config, bg_conf
     secondary_text_color = styles.get("secondary_text", "#666")
     font_family = styles.get("font_family", "-apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif")
     heading_font_family = styles.get("heading_font_family", font_family)
-    wrapper_background_image = styles.get("wrapper_background_image", "none")
-    wrapper_background_size = styles.get("wrapper_background_size", "auto")
-    wrapper_border = styles.get("wrapper_border", "none")
-    wrapper_padding = styles.get("wrapper_padding", "20px")
-    wrapper_inner_shadow = styles.get("wrapper_inner_shadow", "")
     divider_style = styles.get("divider_style", "")
     image_shadow = styles.get("image_shadow", shadow)
-    line_height = styles.get("line_height", "1.8")
     paragraph_margin = styles.get("paragraph_margin", "12px 0")
 
     # 标题样式生成函数 - 精细化设计，符合各主题特质
@@ -3433,30 +5546,6 @@ def generate_styled_html(content, theme_config, code_theme, font_config, bg_conf
     h2_style = get_h2_style(h2_style_type, primary_color, secondary_color, accent_color, border_radius, bg_color)
     h3_style = get_h3_style(h3_style_type, primary_color, secondary_color, accent_color, border_radius, bg_color)
 
-    # 获取导出背景颜色（如果用户选择了非透明背景，则使用用户选择的背景）
-    export_bg_color = bg_config.get("color", "transparent")
-    # 如果背景是透明的，使用主题的背景色
-    final_bg_color = export_bg_color if export_bg_color != "transparent" else bg_color
-
-    # 微信支持的样式模板
-    wrapper_style = f"""
-        background-color: {final_bg_color};
-        background-image: {wrapper_background_image};
-        background-size: {wrapper_background_size};
-        padding: {wrapper_padding};
-        font-family: {font_family};
-        font-size: {base_font};
-        color: {text_color};
-        line-height: {line_height};
-        word-wrap: break-word;
-        border-radius: {border_radius};
-        box-shadow: {shadow};
-        border: {wrapper_border};
-        position: relative;
-    """
-    if wrapper_inner_shadow:
-        wrapper_style += f" box-shadow: {shadow}, {wrapper_inner_shadow};"
-
     p_style = f"""
         margin: {paragraph_margin};
         text-align: justify;
@@ -3662,86 +5751,197 @@ def generate_styled_html(content, theme_config, code_theme, font_config, bg_conf
         box-shadow: {image_shadow};
     """
 
-    # 应用样式到内容
-    styled_content = content
+    mermaid_border = secondary_color
+    mermaid_border_rgba = mermaid_border if mermaid_border.startswith('rgba') else f"rgba({_hex_to_rgb(mermaid_border)}, 0.22)"
+
+    return MappingProxyType({
+        "h1": h1_style,
+        "h2": h2_style,
+        "h3": h3_style,
+        "p": p_style,
+        "blockquote": blockquote_style,
+        "code_inline": code_inline_style,
+        "code_block": code_block_style,
+        "code_in_block": code_in_block_style,
+        "table": table_style,
+        "th": th_style.rstrip(),
+        "td_odd": td_style.rstrip(),
+        "td_even": td_style_even.rstrip(),
+        "list": list_style,
+        "li": li_style,
+        "hr": hr_style,
+        "img": img_style,
+        "wrapper": build_wrapper_style(theme_config, font_config, bg_config),
+        "border_radius": border_radius,
+        "mermaid_container": (
+            f"margin: 18px 0; padding: 16px; border: 1px dashed {mermaid_border_rgba}; "
+            f"border-radius: {styles.get('border_radius', '8px')}; background: {styles.get('blockquote_bg', '#f8f9fa')}; overflow-x: auto;"
+        ),
+        "mermaid_status": f"font-size: 12px; color: {styles.get('secondary_text', '#666666')};",
+        "opening_tags": MappingProxyType({
+            "h1": f'<h1 style="{h1_style}">',
+            "h2": f'<h2 style="{h2_style}">',
+            "h3": f'<h3 style="{h3_style}">',
+            "h4": f'<h4 style="{h3_style}">',
+            "h5": f'<h5 style="{h3_style}">',
+            "h6": f'<h6 style="{h3_style}">',
+            "p": f'<p style="{p_style}">',
+            "blockquote": f'<blockquote style="{blockquote_style}">',
+            "code": f'<code style="{code_inline_style}">',
+            "ul": f'<ul style="{list_style}">',
+            "ol": f'<ol style="{list_style}">',
+            "li": f'<li style="{li_style}">',
+            "hr": f'<hr style="{hr_style}">',
+            "img": f'<img style="{img_style}"'
+        })
+    })
+
 
-    # 先处理代码块内的 code 标签，用临时标记替换
-    styled_content = re.sub(
-        r'<pre class="code-block" data-lang="([^"]*)"><code>',
-        r'<pre class="code-block" data-lang="\1" data-code-inner="true"><code-inner>',
-        styled_content
+@functools.lru_cache(maxsize=None)
+def compile_render_stylesheet(theme, code_theme, font_size, background):
+    """按主题组合编译样式表，每个进程每种组合只构建一次。"""
+    return build_render_stylesheet(
+        THEMES[theme],
+        CODE_THEMES[code_theme],
+        FONT_SIZES[font_size],
+        BACKGROUNDS[background]
     )
 
-    # 处理表格 - 为每一行添加交替样式
-    def style_table_rows(match):
-        table_content = match.group(1)
-        # 找到所有行
-        rows = re.findall(r'<tr>(.*?)</tr>', table_content, re.DOTALL)
-        styled_rows = []
-        for idx, row in enumerate(rows):
-            # 检查是否为表头行（包含 th）
-            if '<th' in row:
-                # 表头行 - 处理带或不带 style 属性的 th
-                def replace_th(m):
-                    existing_style = m.group(1) or ''
-                    # 合并样式，保留原有的 text-align
-                    merged_style = th_style.rstrip()
-                    if 'text-align' in existing_style:
-                        align_match = re.search(r'text-align:\s*[^;]+', existing_style)
-                        if align_match:
-                            merged_style = align_match.group(0) + '; ' + merged_style
-                    return f'<th style="{merged_style}">'
-                styled_row = re.sub(r'<th(?:\s+style=\"([^\"]*)\")?>', replace_th, row)
-                styled_rows.append(f'<tr>{styled_row}</tr>')
-            else:
-                # 数据行 - 交替背景，处理带或不带 style 属性的 td
-                current_td_style = td_style if idx % 2 == 1 else td_style_even
-                def replace_td(m):
-                    existing_style = m.group(1) or ''
-                    merged_style = current_td_style.rstrip()
-                    if 'text-align' in existing_style:
-                        align_match = re.search(r'text-align:\s*[^;]+', existing_style)
-                        if align_match:
-                            merged_style = align_match.group(0) + '; ' + merged_style
-                    return f'<td style="{merged_style}">'
-                styled_row = re.sub(r'<td(?:\s+style=\"([^\"]*)\")?>', replace_td, row)
-                styled_rows.append(f'<tr>{styled_row}</tr>')
-        return f'<table style="{table_style}">{"".join(styled_rows)}</table>'
-
-    # 替换表格（先处理表格，避免与其他样式冲突）
-    styled_content = re.sub(r'<table>(.*?)</table>', style_table_rows, styled_content, flags=re.DOTALL)
-
-    # 应用其他样式（排除表格相关，因为上面已处理）
-    replacements = [
-        (r'<h1>', f'<h1 style="{h1_style}">'),
-        (r'</h1>', '</h1>'),
-        (r'<h2>', f'<h2 style="{h2_style}">'),
-        (r'</h2>', '</h2>'),
-        (r'<h3>', f'<h3 style="{h3_style}">'),
-        (r'</h3>', '</h3>'),
-        (r'<h4>', f'<h4 style="{h3_style}">'),
-        (r'<h5>', f'<h5 style="{h3_style}">'),
-        (r'<h6>', f'<h6 style="{h3_style}">'),
-        (r'<p>', f'<p style="{p_style}">'),
-        (r'<blockquote>', f'<blockquote style="{blockquote_style}">'),
-        (r'<code>', f'<code style="{code_inline_style}">'),
-        (r'<ul>', f'<ul style="{list_style}">'),
-        (r'<ol>', f'<ol style="{list_style}">'),
-        (r'<li>', f'<li style="{li_style}">'),
-        (r'<hr\s*/?>', f'<hr style="{hr_style}">'),
-        # 只匹配没有 data-slider-img 属性的图片，避免覆盖幻灯片图片样式
-        (r'<img(?![^>]*data-slider-img)', f'<img style="{img_style}"'),
-    ]
 
-    for pattern, replacement in replacements:
-        styled_content = re.sub(pattern, replacement, styled_content)
+def get_render_stylesheet(theme="default", code_theme="github", font_size="medium", background="warm"):
+    """返回规范化参数后对应的预编译样式表。"""
+    return compile_render_stylesheet(*normalize_render_options(theme, code_theme, font_size, background))
+
+
+# 各分支共用开头的 "<"，正则引擎只需在 "<" 处尝试匹配
+STYLED_HTML_TAG_PATTERN = (
+    r'pre class="code-block" data-lang="(?P<code_lang>[^"]*)"><code>'
+    r'|(?P<tag>h[1-6]|p|blockquote|code|ul|ol|li)>'
+    r'|(?P<hr>hr\s*/?>)'
+    # 只匹配没有 data-slider-img 属性的图片，避免覆盖幻灯片图片样式
+    r'|(?P<img>img)(?![^>]*data-slider-img)'
+)
+STYLED_HTML_PATTERN = re.compile(r'<(?:table>(?P<table>.*?)</table>|' + STYLED_HTML_TAG_PATTERN + ')', re.DOTALL)
+TABLE_ROW_PATTERN = re.compile(r'<tr>(.*?)</tr>', re.DOTALL)
+TABLE_ROW_STYLED_PATTERN = re.compile(
+    r'<(?:(?P<cell>t[hd])(?:\s+style="(?P<cell_style>[^"]*)")?>|' + STYLED_HTML_TAG_PATTERN + ')'
+)
+TEXT_ALIGN_PATTERN = re.compile(r'text-align:\s*[^;]+')
+
+
+def merge_table_cell_style(existing_style, cell_style):
+    """合并单元格样式，保留 Markdown 表格原有的 text-align。"""
+    if existing_style and 'text-align' in existing_style:
+        align_match = TEXT_ALIGN_PATTERN.search(existing_style)
+        if align_match:
+            return align_match.group(0) + '; ' + cell_style
+    return cell_style
+
+
+def style_table_html(table_content, stylesheet):
+    """为表格补充样式：表头统一样式，数据行按奇偶交替背景。"""
+    styled_rows = []
+    for idx, row in enumerate(TABLE_ROW_PATTERN.findall(table_content)):
+        # 表头行只处理 th，数据行只处理 td，与原有逐行替换规则一致
+        if '<th' in row:
+            cell_tag, cell_style = 'th', stylesheet["th"]
+        else:
+            cell_tag = 'td'
+            cell_style = stylesheet["td_odd"] if idx % 2 == 1 else stylesheet["td_even"]
+        styled_row = style_html_tags(row, stylesheet, TABLE_ROW_STYLED_PATTERN, (cell_tag, cell_style))
+        styled_rows.append(f'<tr>{styled_row}</tr>')
+    return f'<table style="{stylesheet["table"]}">{"".join(styled_rows)}</table>'
+
+
+def style_html_tags(html_content, stylesheet, pattern=STYLED_HTML_PATTERN, table_cell=None):
+    """单次扫描 HTML，为每个需要内联样式的开始标签补充样式。"""
+    opening_tags = stylesheet["opening_tags"]
+
+    def replace_tag(match):
+        tag_name = match.group("tag")
+        if tag_name:
+            return opening_tags[tag_name]
+        if match.group("img"):
+            return opening_tags["img"]
+        code_lang = match.group("code_lang")
+        if code_lang is not None:
+            return (
+                f'<pre class="code-block" data-lang="{code_lang}" style="{stylesheet["code_block"]}">'
+                f'<code style="{stylesheet["code_in_block"]}">'
+            )
+        if match.group("hr"):
+            return opening_tags["hr"]
+        if table_cell is not None:
+            cell_tag, cell_style = table_cell
+            if match.group("cell") != cell_tag:
+                return match.group(0)
+            return f'<{cell_tag} style="{merge_table_cell_style(match.group("cell_style"), cell_style)}">'
+        return style_table_html(match.group("table"), stylesheet)
+
+    return pattern.sub(replace_tag, html_content)
 
-    # 恢复代码块并应用正确的样式
-    styled_content = re.sub(
-        r'<pre class="code-block" data-lang="([^"]*)" data-code-inner="true"><code-inner>',
-        f'<pre class="code-block" data-lang="\\1" style="{code_block_style}"><code style="{code_in_block_style}">',
-        styled_content
-    )
+
+def generate_styled_html(content, theme_config, code_theme, font_config, bg_config, include_wrapper=True, stylesheet=None):
+    """生成带内联样式的HTML，确保微信兼容；include_wrapper=False 时只返回内容部分"""
+    if stylesheet is None:
+        stylesheet = build_render_stylesheet(theme_config, code_theme, font_config, bg_config)
+
+    styled_content = style_html_tags(content, stylesheet)
+
+    if not include_wrapper:
+        return styled_content
+
+    return wrap_styled_html(styled_content, stylesheet)
+
+
+def build_wrapper_style(theme_config, font_config, bg_config):
+    """生成文章最外层 section 的内联样式。"""
+    styles = theme_config.get("styles", {
+        "bg_color": "#ffffff",
+        "border_radius": "6px",
+        "shadow": "0 2px 8px rgba(0,0,0,0.06)"
+    })
+    bg_color = styles["bg_color"]
+    border_radius = styles["border_radius"]
+    shadow = styles["shadow"]
+    text_color = styles.get("text_color", "#333")
+    font_family = styles.get("font_family", "-apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif")
+    wrapper_background_image = styles.get("wrapper_background_image", "none")
+    wrapper_background_size = styles.get("wrapper_background_size", "auto")
+    wrapper_border = styles.get("wrapper_border", "none")
+    wrapper_padding = styles.get("wrapper_padding", "20px")
+    wrapper_inner_shadow = styles.get("wrapper_inner_shadow", "")
+    line_height = styles.get("line_height", "1.8")
+
+    # 获取导出背景颜色（如果用户选择了非透明背景，则使用用户选择的背景）
+    export_bg_color = bg_config.get("color", "transparent")
+    # 如果背景是透明的，使用主题的背景色
+    final_bg_color = export_bg_color if export_bg_color != "transparent" else bg_color
+
+    # 微信支持的样式模板
+    wrapper_style = f"""
+        background-color: {final_bg_color};
+        background-image: {wrapper_background_image};
+        background-size: {wrapper_background_size};
+        padding: {wrapper_padding};
+        font-family: {font_family};
+        font-size: {font_config["base"]};
+        color: {text_color};
+        line-height: {line_height};
+        word-wrap: break-word;
+        border-radius: {border_radius};
+        box-shadow: {shadow};
+        border: {wrapper_border};
+        position: relative;
+    """
+    if wrapper_inner_shadow:
+        wrapper_style += f" box-shadow: {shadow}, {wrapper_inner_shadow};"
+    return wrapper_style
+
+
+def wrap_styled_html(styled_content, stylesheet):
+    """用主题外层 section 包装已加好内联样式的内容。"""
+    wrapper_style = stylesheet["wrapper"]
 
     # 包装完整HTML
     full_html = f'''
@@ -3787,74 +5987,50 @@ def index():
 
 @app.route('/share/<share_id>')
 def share_article(share_id):
-    """分享页。"""
-    payload = load_share_payload(share_id)
-    if not payload:
-        abort(404, description="分享内容不存在或已失效")
+    """分享页，命中缓存时只返回渲染好的 HTML，支持 ETag 条件请求。
 
-    settings = payload.get("settings") or {}
-    theme, code_theme, font_size, background = normalize_render_options(
-        settings.get("theme", "default"),
-        settings.get("code_theme", "github"),
-        settings.get("font_size", "medium"),
-        settings.get("background", "warm")
-    )
+    不发送 Last-Modified：页面还随模板和站点配置变化，创建时间不能代表内容的修改时间，只按强 ETag 判断。
+    """
+    safe_id = normalize_share_id(share_id)
+    if not safe_id:
+        abort(404, description="分享内容不存在或已失效")
+    if safe_id != share_id:
+        # 大小写或多余字符不同的地址统一跳转到规范地址，不为它们单独渲染和缓存
+        return redirect(url_for("share_article", share_id=safe_id), code=301)
 
-    markdown_text = payload.get("markdown", "")
-    article_html = payload.get("html") or process_markdown(
-        markdown_text,
-        theme,
-        code_theme,
-        font_size,
-        background
-    )
-    title = payload.get("title") or find_first_heading(markdown_text) or "未命名文章"
-    excerpt = trim_meta_text(payload.get("excerpt") or extract_plain_text_from_markdown(markdown_text), 180)
-    published_at = normalize_iso_timestamp(payload.get("created_at"))
-    canonical_url = build_public_url("share_article", share_id=share_id)
-    og_image_url = (
-        (payload.get("og_image_url") or "").strip()
-        or build_share_og_image_url(markdown_text, article_html, page_url=canonical_url, allow_local_copy=False)
-    )
-    page_qr_svg = create_share_qr_svg(canonical_url)
+    entry = get_share_page(safe_id, get_public_base_url())
+    if entry is None:
+        abort(404, description="分享内容不存在或已失效")
 
-    return render_template(
-        "share.html",
-        title=title,
-        excerpt=excerpt,
-        article_html=article_html,
-        share_url=canonical_url,
-        theme_name=THEMES[theme]["name"],
-        created_at_label=format_share_timestamp(payload.get("created_at")),
-        code_theme_name=CODE_THEMES[code_theme]["name"],
-        site_name=SITE_NAME,
-        canonical_url=canonical_url,
-        page_qr_svg=page_qr_svg,
-        published_at=published_at,
-        og_image_url=og_image_url,
-        structured_data=build_share_structured_data(
-            title,
-            excerpt or title,
-            canonical_url,
-            published_at,
-            og_image_url
-        )
-    )
+    body, etag, gzip_body = entry
+    if client_accepts_gzip():
+        # 不同编码的响应体不同，强 ETag 也要区分
+        response = app.response_class(gzip_body, mimetype="text/html")
+        response.headers["Content-Encoding"] = "gzip"
+        etag = f"{etag}-gzip"
+    else:
+        response = app.response_class(body, mimetype="text/html")
+    response.vary.add("Accept-Encoding")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = SHARE_PAGE_MAX_AGE
+    return response.make_conditional(request)
 
 
 @app.route('/share/images/<path:filename>')
 def share_image_file(filename):
     """输出分享页相关的本地图片资源。"""
-    safe_name = os.path.basename(filename or "")
-    if safe_name != filename or not safe_name:
+    image_path = find_share_image_path(filename)
+    if image_path is None:
         abort(404)
 
-    for image_dir in iter_share_image_dirs():
-        image_path = image_dir / safe_name
-        if image_path.exists() and image_path.is_file():
-            return send_from_directory(image_dir, safe_name, conditional=True)
-
-    abort(404)
+    if image_path.name.startswith("formula-"):
+        # 公式图片按内容哈希命名，内容永不变化，浏览器和 CDN 可以长期缓存
+        response = send_from_directory(image_path.parent, image_path.name, conditional=True, max_age=FORMULA_IMAGE_MAX_AGE)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+    return send_from_directory(image_path.parent, image_path.name, conditional=True)
 
 
 @app.route('/robots.txt')
@@ -3870,25 +6046,25 @@ def robots_txt():
 
 @app.route('/sitemap.xml')
 def sitemap_xml():
-    """输出 sitemap.xml。"""
-    entries = [{
-        "loc": build_public_url("index"),
-        "lastmod": ""
-    }]
-    entries.extend(iter_share_sitemap_entries())
+    """输出 sitemap.xml；地址数超过 SITEMAP_MAX_URLS 时输出 sitemap 索引。"""
+    snapshot = get_sitemap_snapshot()
+    if snapshot is None:
+        xml, etag = render_sitemap_document([render_sitemap_url(build_public_url("index"))])
+        return build_sitemap_response(xml, etag, "")
+
+    xml, etag = snapshot["index"] or snapshot["pages"][0][:2]
+    return build_sitemap_response(xml, etag, snapshot["updated_at"])
 
-    xml_lines = ['<?xml version="1.0" encoding="UTF-8"?>',
-                 '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">']
 
-    for entry in entries:
-        xml_lines.append("  <url>")
-        xml_lines.append(f"    <loc>{html_lib.escape(entry['loc'])}</loc>")
-        if entry.get("lastmod"):
-            xml_lines.append(f"    <lastmod>{html_lib.escape(entry['lastmod'])}</lastmod>")
-        xml_lines.append("  </url>")
+@app.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    """输出拆分后的第 page 页 sitemap。"""
+    snapshot = get_sitemap_snapshot()
+    if snapshot is None or not 1 <= page <= len(snapshot["pages"]):
+        abort(404)
 
-    xml_lines.append("</urlset>")
-    return app.response_class("\n".join(xml_lines) + "\n", mimetype="application/xml")
+    xml, etag, _ = snapshot["pages"][page - 1]
+    return build_sitemap_response(xml, etag, snapshot["updated_at"])
 
 
 @app.route('/api/convert', methods=['POST'])
@@ -3904,21 +6080,47 @@ def api_convert():
             }), 400
 
         md_text = data['markdown']
+        if not isinstance(md_text, str):
+            return jsonify({
+                'success': False,
+                'error': 'markdown 必须是字符串'
+            }), 400
+
+        invalid_field = find_invalid_render_option(data)
+        if invalid_field:
+            return jsonify({
+                'success': False,
+                'error': f'{invalid_field} 必须是字符串'
+            }), 400
+
         theme, code_theme, font_size, background = normalize_render_options(
             data.get('theme', 'default'),
             data.get('code_theme', 'github'),
             data.get('font_size', 'medium'),
             data.get('background', 'warm')
         )
+        math_format = normalize_math_format(data.get('math_format'))
+        math_images = normalize_math_images(data.get('math_images'))
 
-        html = process_markdown(md_text, theme, code_theme, font_size, background)
+        html = process_markdown_cached(
+            md_text,
+            theme,
+            code_theme,
+            font_size,
+            background,
+            incremental=coerce_bool_flag(data.get('incremental'), 0) == 1,
+            math_format=math_format,
+            math_images=math_images
+        )
 
         return jsonify({
             'success': True,
             'html': html,
             'theme': THEMES[theme],
             'font_size': FONT_SIZES[font_size],
-            'background': BACKGROUNDS[background]
+            'background': BACKGROUNDS[background],
+            'math_format': math_format,
+            'math_images': math_images
         })
 
     except Exception as e:
@@ -3928,6 +6130,160 @@ def api_convert():
         }), 500
 
 
+@app.route('/api/convert/stream', methods=['POST'])
+def api_convert_stream():
+    """API接口：分块流式返回转换后的HTML，先渲染完的块先发送"""
+    data = request.get_json(silent=True)
+
+    if not data or 'markdown' not in data:
+        return jsonify({
+            'success': False,
+            'error': '请提供markdown内容'
+        }), 400
+
+    md_text = data['markdown']
+    if not isinstance(md_text, str):
+        return jsonify({
+            'success': False,
+            'error': 'markdown 必须是字符串'
+        }), 400
+
+    invalid_field = find_invalid_render_option(data)
+    if invalid_field:
+        return jsonify({
+            'success': False,
+            'error': f'{invalid_field} 必须是字符串'
+        }), 400
+
+    theme, code_theme, font_size, background = normalize_render_options(
+        data.get('theme', 'default'),
+        data.get('code_theme', 'github'),
+        data.get('font_size', 'medium'),
+        data.get('background', 'warm')
+    )
+    math_format = normalize_math_format(data.get('math_format'))
+    math_images = normalize_math_images(data.get('math_images'))
+
+    def generate():
+        try:
+            yield from iter_markdown_render_stream(
+                md_text, theme, code_theme, font_size, background, math_format, math_images
+            )
+        except Exception:
+            # 响应头已经发出，无法再改状态码，追加结尾标记告诉客户端内容不完整
+            app.logger.exception("Streaming conversion failed")
+            yield STREAM_RENDER_ERROR_MARKER
+
+    return Response(
+        generate(),
+        mimetype='text/html',
+        headers={
+            'Cache-Control': 'no-store',
+            'X-Accel-Buffering': 'no',
+            'X-Math-Format': math_format,
+            'X-Math-Images': math_images,
+            'X-Stream-Error-Marker': STREAM_RENDER_ERROR_MARKER
+        }
+    )
+
+
+@app.route('/api/math/<cache_key>.<image_format>')
+def api_math_image(cache_key, image_format):
+    """按公式哈希输出延迟加载的公式图片，内容由哈希决定，可长期缓存"""
+    if not re.fullmatch(r"[0-9a-f]{64}", cache_key) or image_format not in MATH_FORMATS:
+        abort(404)
+
+    img_data = render_deferred_formula(cache_key, image_format)
+    if img_data is None:
+        # 渲染失败不缓存在服务端，只让浏览器短时间内不再重试，前端会显示公式原文
+        response = app.response_class("公式渲染失败", status=404, mimetype="text/plain")
+        response.cache_control.max_age = FORMULA_FAILURE_MAX_AGE
+        return response
+
+    response = app.response_class(
+        img_data,
+        mimetype="image/svg+xml" if image_format == "svg" else "image/png"
+    )
+    response.set_etag(f"{cache_key}.{image_format}")
+    response.cache_control.public = True
+    response.cache_control.max_age = FORMULA_IMAGE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@app.route('/api/convert/batch', methods=['POST'])
+def api_convert_batch():
+    """API接口：批量转换，多篇文档在进程池中并行渲染，同一文档的多个主题共享一次解析"""
+    data = request.get_json(silent=True)
+    jobs = data.get('jobs') if isinstance(data, dict) else None
+
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({
+            'success': False,
+            'error': '请提供 jobs 列表'
+        }), 400
+
+    if len(jobs) > BATCH_RENDER_MAX_JOBS:
+        return jsonify({
+            'success': False,
+            'error': f'单次最多提交 {BATCH_RENDER_MAX_JOBS} 个任务'
+        }), 400
+
+    render_jobs = []
+    for index, job in enumerate(jobs):
+        if not isinstance(job, dict) or not isinstance(job.get('markdown'), str):
+            return jsonify({
+                'success': False,
+                'error': f'第 {index + 1} 个任务缺少 markdown 内容'
+            }), 400
+
+        invalid_field = find_invalid_render_option(job)
+        if invalid_field:
+            return jsonify({
+                'success': False,
+                'error': f'第 {index + 1} 个任务的 {invalid_field} 必须是字符串'
+            }), 400
+
+        options = normalize_render_options(
+            job.get('theme', 'default'),
+            job.get('code_theme', 'github'),
+            job.get('font_size', 'medium'),
+            job.get('background', 'warm')
+        )
+        math_options = (normalize_math_format(job.get('math_format')), normalize_math_images(job.get('math_images')))
+        render_jobs.append((job['markdown'], (*options, *math_options)))
+
+    started_at = time.perf_counter()
+    try:
+        rendered = render_markdown_batch(render_jobs)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+    results = []
+    for index, ((_, options), result) in enumerate(zip(render_jobs, rendered)):
+        theme, code_theme, font_size, background, math_format, math_images = options
+        results.append({
+            'index': index,
+            'success': 'error' not in result,
+            'theme': theme,
+            'code_theme': code_theme,
+            'font_size': font_size,
+            'background': background,
+            'math_format': math_format,
+            'math_images': math_images,
+            **result
+        })
+
+    return jsonify({
+        'success': True,
+        'results': results,
+        'elapsed_ms': round((time.perf_counter() - started_at) * 1000, 3)
+    })
+
+
 @app.route('/api/upload/image', methods=['POST'])
 def api_upload_image():
     """上传图片并返回可公开访问的 Markdown 图片地址。"""
@@ -3984,12 +6340,24 @@ def api_share():
     try:
         data = request.get_json() or {}
         md_text = data.get("markdown", "")
+        if not isinstance(md_text, str):
+            return jsonify({
+                "success": False,
+                "error": "markdown 必须是字符串"
+            }), 400
         if not md_text.strip():
             return jsonify({
                 "success": False,
                 "error": "请先输入文章内容"
             }), 400
 
+        invalid_field = find_invalid_render_option(data)
+        if invalid_field:
+            return jsonify({
+                "success": False,
+                "error": f"{invalid_field} 必须是字符串"
+            }), 400
+
         theme, code_theme, font_size, background = normalize_render_options(
             data.get("theme", "default"),
             data.get("code_theme", "github"),
@@ -4010,9 +6378,8 @@ def api_share():
             share_url
         )
 
-        share_path = get_share_file_path(share_id)
-        with share_path.open("w", encoding="utf-8") as fp:
-            json.dump(payload, fp, ensure_ascii=False, indent=2)
+        save_share_payload(payload)
+        warm_share_page_cache(share_id, payload, get_public_base_url())
 
         return jsonify({
             "success": True,
@@ -4020,7 +6387,7 @@ def api_share():
             "share_url": share_url,
             "title": payload["title"],
             "created_at_label": format_share_timestamp(payload["created_at"]),
-            "qr_svg": create_share_qr_svg(share_url)
+            "qr_svg": payload["qr_svg"]
         })
     except Exception as e:
         return jsonify({
@@ -4035,12 +6402,24 @@ def api_wechat_draft():
     try:
         data = request.get_json() or {}
         md_text = data.get("markdown", "")
+        if not isinstance(md_text, str):
+            return jsonify({
+                "success": False,
+                "error": "markdown 必须是字符串"
+            }), 400
         if not md_text.strip():
             return jsonify({
                 "success": False,
                 "error": "请先输入文章内容"
             }), 400
 
+        invalid_field = find_invalid_render_option(data)
+        if invalid_field:
+            return jsonify({
+                "success": False,
+                "error": f"{invalid_field} 必须是字符串"
+            }), 400
+
         wechat_config = data.get("wechat_config") or {}
         app_key = (wechat_config.get("app_key") or "").strip()
         app_secret = (wechat_config.get("app_secret") or "").strip()
@@ -4065,7 +6444,8 @@ def api_wechat_draft():
             font_size,
             background,
             access_token,
-            meta=data.get("meta") or {}
+            meta=data.get("meta") or {},
+            account_key=app_key
         )
 
         response_data = wechat_api_request(
@@ -4081,7 +6461,8 @@ def api_wechat_draft():
             "success": True,
             "title": article_payload["article"]["title"],
             "media_id": media_id,
-            "uploaded_image_count": article_payload["uploaded_image_count"]
+            "uploaded_image_count": article_payload["uploaded_image_count"],
+            "reused_image_count": article_payload["reused_image_count"]
         })
     except RuntimeError as exc:
         return jsonify({
@@ -4279,7 +6660,21 @@ def api_health():
     return jsonify({
         'status': 'ok',
         'service': 'md2we',
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'caches': collect_cache_stats(),
+        'circuit_breakers': collect_circuit_breaker_stats()
+    })
+
+
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """进程内缓存与计数器指标"""
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'caches': collect_cache_stats(),
+        'circuit_breakers': collect_circuit_breaker_stats(),
+        'counters': get_metric_counters()
     })
 
 
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the Markdown render pipeline.
+
+Run from the repository root:
+
+    python3 scripts/benchmark_render.py [styler] [converter] [--repeat N]
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+
+SAMPLE_SECTION = """## 小节标题
+
+这是一段用于压测的正文，包含 **加粗**、`inline code` 和 [链接](https://example.com)。
+第二行文字继续描述内容，保证段落足够长，以便模拟真实的公众号文章排版。
+
+> 引用内容，用于测试 blockquote 样式。
+
+- 列表项一
+- 列表项二，带 `code`
+  - 嵌套列表
+
+1. 有序列表一
+2. 有序列表二
+
+| 名称 | 说明 | 数值 |
+|:-----|:----:|-----:|
+| alpha | `a` | 1 |
+| beta | b | 2 |
+| gamma | c | 3 |
+
+![示意图](https://example.com/image.png)
+
+```python
+def handler(event):
+    return {"status": 200, "body": event}
+```
+
+---
+"""
+
+
+def build_sample_markdown(sections):
+    """生成指定小节数的长文。"""
+    return "# 压测文章\n\n" + "\n".join(SAMPLE_SECTION for _ in range(sections))
+
+
+def legacy_style_html_content(content, stylesheet):
+    """重构前 generate_styled_html 使用的逐个 re.sub 实现，作为对照基线。"""
+    th_style = stylesheet["th"]
+    td_style = stylesheet["td_odd"]
+    td_style_even = stylesheet["td_even"]
+
+    styled_content = re.sub(
+        r'<pre class="code-block" data-lang="([^"]*)"><code>',
+        r'<pre class="code-block" data-lang="\1" data-code-inner="true"><code-inner>',
+        content
+    )
+
+    def style_table_rows(match):
+        rows = re.findall(r'<tr>(.*?)</tr>', match.group(1), re.DOTALL)
+        styled_rows = []
+        for idx, row in enumerate(rows):
+            if '<th' in row:
+                def replace_th(m):
+                    existing_style = m.group(1) or ''
+                    merged_style = th_style
+                    if 'text-align' in existing_style:
+                        align_match = re.search(r'text-align:\s*[^;]+', existing_style)
+                        if align_match:
+                            merged_style = align_match.group(0) + '; ' + merged_style
+                    return f'<th style="{merged_style}">'
+                styled_row = re.sub(r'<th(?:\s+style=\"([^\"]*)\")?>', replace_th, row)
+                styled_rows.append(f'<tr>{styled_row}</tr>')
+            else:
+                current_td_style = td_style if idx % 2 == 1 else td_style_even
+
+                def replace_td(m):
+                    existing_style = m.group(1) or ''
+                    merged_style = current_td_style
+                    if 'text-align' in existing_style:
+                        align_match = re.search(r'text-align:\s*[^;]+', existing_style)
+                        if align_match:
+                            merged_style = align_match.group(0) + '; ' + merged_style
+                    return f'<td style="{merged_style}">'
+                styled_row = re.sub(r'<td(?:\s+style=\"([^\"]*)\")?>', replace_td, row)
+                styled_rows.append(f'<tr>{styled_row}</tr>')
+        return f'<table style="{stylesheet["table"]}">{"".join(styled_rows)}</table>'
+
+    styled_content = re.sub(r'<table>(.*?)</table>', style_table_rows, styled_content, flags=re.DOTALL)
+
+    opening_tags = stylesheet["opening_tags"]
+    replacements = [
+        (r'<h1>', opening_tags["h1"]),
+        (r'</h1>', '</h1>'),
+        (r'<h2>', opening_tags["h2"]),
+        (r'</h2>', '</h2>'),
+        (r'<h3>', opening_tags["h3"]),
+        (r'</h3>', '</h3>'),
+        (r'<h4>', opening_tags["h4"]),
+        (r'<h5>', opening_tags["h5"]),
+        (r'<h6>', opening_tags["h6"]),
+        (r'<p>', opening_tags["p"]),
+        (r'<blockquote>', opening_tags["blockquote"]),
+        (r'<code>', opening_tags["code"]),
+        (r'<ul>', opening_tags["ul"]),
+        (r'<ol>', opening_tags["ol"]),
+        (r'<li>', opening_tags["li"]),
+        (r'<hr\s*/?>', opening_tags["hr"]),
+        (r'<img(?![^>]*data-slider-img)', opening_tags["img"]),
+    ]
+    for pattern, replacement in replacements:
+        styled_content = re.sub(pattern, replacement, styled_content)
+
+    return re.sub(
+        r'<pre class="code-block" data-lang="([^"]*)" data-code-inner="true"><code-inner>',
+        lambda m: (
+            f'<pre class="code-block" data-lang="{m.group(1)}" style="{stylesheet["code_block"]}">'
+            f'<code style="{stylesheet["code_in_block"]}">'
+        ),
+        styled_content
+    )
+
+
+def time_call(func, repeat):
+    """返回多次调用的平均耗时（毫秒）。"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def benchmark_styler(repeat):
+    """对比单次扫描样式器与旧版 re.sub 级联的输出和耗时。"""
+    print("== styler: style_html_tags vs legacy re.sub cascade ==")
+    for sections in (5, 50, 200):
+        md_text = build_sample_markdown(sections)
+        for theme in ("default", "cyberpunk", "paper_journal"):
+            stylesheet = app.get_render_stylesheet(theme)
+            unstyled_html = app.markdown.markdown(md_text, extensions=["tables", "nl2br", "sane_lists"])
+            unstyled_html = unstyled_html.replace(
+                "<pre><code>",
+                '<pre class="code-block" data-lang="python"><code>'
+            )
+            expected = legacy_style_html_content(unstyled_html, stylesheet)
+            actual = app.style_html_tags(unstyled_html, stylesheet)
+            if actual != expected:
+                raise SystemExit(f"output mismatch: sections={sections} theme={theme}")
+
+        legacy_ms = time_call(lambda: legacy_style_html_content(unstyled_html, stylesheet), repeat)
+        single_pass_ms = time_call(lambda: app.style_html_tags(unstyled_html, stylesheet), repeat)
+        print(
+            f"{len(unstyled_html):>9,} chars  legacy {legacy_ms:8.3f} ms  "
+            f"single-pass {single_pass_ms:8.3f} ms  speedup {legacy_ms / single_pass_ms:5.2f}x"
+        )
+
+
+def benchmark_converter(repeat):
+    """对比每次新建 markdown.Markdown 与复用线程内转换器的单次调用耗时。"""
+    print("== converter: new markdown.Markdown per call vs per-thread reset() ==")
+    extensions = list(app.MARKDOWN_EXTENSIONS)
+    setup_new_ms = time_call(lambda: app.markdown.Markdown(extensions=extensions), repeat)
+    setup_reused_ms = time_call(app.get_markdown_converter, repeat)
+    print(f"setup only          new {setup_new_ms:8.3f} ms  reused {setup_reused_ms:8.3f} ms")
+
+    for sections in (1, 50):
+        md_text = build_sample_markdown(sections)
+        expected = app.markdown.Markdown(extensions=extensions).convert(md_text)
+        if app.get_markdown_converter().convert(md_text) != expected:
+            raise SystemExit(f"output mismatch: sections={sections}")
+
+        new_ms = time_call(lambda: app.markdown.Markdown(extensions=extensions).convert(md_text), repeat)
+        reused_ms = time_call(lambda: app.get_markdown_converter().convert(md_text), repeat)
+        print(f"{len(md_text):>9,} chars  new {new_ms:8.3f} ms  reused {reused_ms:8.3f} ms")
+
+
+BENCHMARKS = {
+    "styler": benchmark_styler,
+    "converter": benchmark_converter,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--repeat", type=int, default=50, help="iterations per measurement")
+    args = parser.parse_args()
+    unknown_names = [name for name in args.names if name not in BENCHMARKS]
+    if unknown_names:
+        parser.error(f"unknown benchmark: {', '.join(unknown_names)}")
+
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name](args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Re-render every share page and export it as static files for nginx.
+
+Run from the repository root after changing templates, themes or site settings:
+
+    python3 scripts/export_static_shares.py [--output DIR] [--site-url URL]
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--output",
+        default=app.SHARE_STATIC_EXPORT_DIR,
+        help="export directory (default: $SHARE_STATIC_EXPORT_DIR)"
+    )
+    parser.add_argument(
+        "--site-url",
+        default=(os.getenv("SITE_URL") or "").strip(),
+        help="public site root used for canonical URLs and QR codes (default: $SITE_URL)"
+    )
+    args = parser.parse_args()
+    if not args.output:
+        parser.error("set SHARE_STATIC_EXPORT_DIR or pass --output")
+    if not args.site_url:
+        parser.error("set SITE_URL or pass --site-url")
+
+    site_url = args.site_url.rstrip("/")
+    start = time.perf_counter()
+    with app.app.test_request_context("/", base_url=site_url):
+        share_count, image_count = app.export_all_static_share_pages(args.output, site_url)
+    elapsed = time.perf_counter() - start
+    print(f"exported {share_count} shares and {image_count} new images to {args.output} in {elapsed:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
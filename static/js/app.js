@@ -37,6 +37,7 @@ class MD2WE {
         this.isDragging = false;
         this.previewRequestId = 0;
         this.mermaidSequence = 0;
+        this.failedFormulaUrls = new Set();
         this.generatedImageDataUrl = '';
         this.generatedImagePrompt = '';
         this.generatedSummary = '';
@@ -1234,7 +1235,8 @@ class MD2WE {
         }
 
         try {
-            const response = await fetch('/api/convert', {
+            // 流式接口按块返回 HTML，长文可以先显示前面已渲染好的部分
+            const response = await fetch('/api/convert/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -1244,20 +1246,69 @@ class MD2WE {
                     theme: this.currentSettings.theme,
                     code_theme: this.currentSettings.codeTheme,
                     font_size: this.currentSettings.fontSize,
-                    background: this.currentSettings.background
+                    background: this.currentSettings.background,
+                    math_format: 'svg',
+                    math_images: 'deferred'
                 })
             });
 
-            const data = await response.json();
-            if (requestId !== this.previewRequestId) {
-                return;
+            if (!response.ok) {
+                const data = await response.json().catch(() => ({}));
+                if (requestId !== this.previewRequestId) {
+                    return;
+                }
+                throw new Error(data.error || '转换失败');
             }
 
-            if (!response.ok || !data.success) {
-                throw new Error(data.error || '转换失败');
+            const errorMarker = response.headers.get('X-Stream-Error-Marker');
+            let html = '';
+            if (response.body && response.body.getReader) {
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                // 每帧最多重绘一次预览，块再多也不会对整段 HTML 反复解析
+                let paintFrame = null;
+                const paint = () => {
+                    paintFrame = null;
+                    this.preview.innerHTML = html;
+                };
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (requestId !== this.previewRequestId) {
+                        if (paintFrame) {
+                            cancelAnimationFrame(paintFrame);
+                        }
+                        reader.cancel().catch(() => {});
+                        return;
+                    }
+                    if (done) {
+                        break;
+                    }
+                    html += decoder.decode(value, { stream: true });
+                    if (!paintFrame) {
+                        paintFrame = requestAnimationFrame(paint);
+                    }
+                }
+                if (paintFrame) {
+                    cancelAnimationFrame(paintFrame);
+                }
+                html += decoder.decode();
+            } else {
+                html = await response.text();
+                if (requestId !== this.previewRequestId) {
+                    return;
+                }
             }
 
-            this.preview.innerHTML = data.html;
+            if (errorMarker && html.endsWith(errorMarker)) {
+                // 流式渲染中途失败，已收到的内容不完整，改用整篇转换接口重新渲染
+                html = await this.fetchPreviewHTML(markdown);
+                if (requestId !== this.previewRequestId) {
+                    return;
+                }
+            }
+
+            this.preview.innerHTML = html;
+            this.loadDeferredFormulas(this.preview);
             await this.renderMermaidDiagrams(this.preview);
         } catch (error) {
             console.error('转换失败:', error);
@@ -1269,6 +1320,65 @@ class MD2WE {
         }
     }
 
+    async fetchPreviewHTML(markdown) {
+        const response = await fetch('/api/convert', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                markdown,
+                theme: this.currentSettings.theme,
+                code_theme: this.currentSettings.codeTheme,
+                font_size: this.currentSettings.fontSize,
+                background: this.currentSettings.background,
+                incremental: true,
+                math_format: 'svg',
+                math_images: 'deferred'
+            })
+        });
+        const data = await response.json().catch(() => ({}));
+        if (!response.ok || !data.success) {
+            throw new Error(data.error || '转换失败');
+        }
+        return data.html;
+    }
+
+    loadDeferredFormulas(container) {
+        // 预览接口只返回公式占位，正文显示后再按公式哈希加载图片，输入延迟不随公式数量增长
+        container.querySelectorAll('img[data-math-src]').forEach((img) => {
+            const url = img.dataset.mathSrc;
+            img.removeAttribute('data-math-src');
+            // 渲染失败过的公式直接显示原文，重绘预览时不再重复请求
+            if (this.failedFormulaUrls.has(url)) {
+                this.replaceFailedFormula(img);
+                return;
+            }
+            img.addEventListener('error', () => {
+                this.failedFormulaUrls.add(url);
+                this.replaceFailedFormula(img);
+            }, { once: true });
+            img.loading = 'lazy';
+            img.src = url;
+        });
+    }
+
+    replaceFailedFormula(img) {
+        // 与服务端公式渲染失败时的代码样式一致
+        const code = document.createElement('code');
+        code.dataset.mathError = 'true';
+        code.textContent = img.dataset.mathLatex || '';
+        if (img.dataset.mathKind === 'block') {
+            const wrapper = document.createElement('div');
+            wrapper.style.cssText = 'text-align: center; margin: 16px 0; padding: 12px; background: #f5f5f5; border-radius: 4px;';
+            wrapper.appendChild(code);
+            img.replaceWith(wrapper);
+            return;
+        }
+        code.style.cssText = 'background: #f5f5f5; padding: 2px 4px; border-radius: 2px;';
+        img.replaceWith(code);
+    }
+
     async renderMermaidDiagrams(container) {
         const nodes = Array.from(container.querySelectorAll('.md2-mermaid[data-mermaid]'));
         if (!nodes.length) {
@@ -1605,8 +1715,54 @@ ${this.escapeHTML(source)}</div>
         });
     }
 
+    async getExportHTML() {
+        // 预览中的公式是 SVG，微信公众号不支持 SVG 图片，导出前替换为服务端渲染的 PNG 公式
+        const svgFormulas = this.preview.querySelectorAll('img[data-math-format="svg"]');
+        if (!svgFormulas.length) {
+            return this.preview.innerHTML;
+        }
+
+        try {
+            const response = await fetch('/api/convert', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    markdown: this.editor.value,
+                    theme: this.currentSettings.theme,
+                    code_theme: this.currentSettings.codeTheme,
+                    font_size: this.currentSettings.fontSize,
+                    background: this.currentSettings.background,
+                    incremental: true,
+                    math_format: 'png'
+                })
+            });
+            const data = await response.json();
+            if (!response.ok || !data.success) {
+                throw new Error(data.error || '转换失败');
+            }
+
+            const rendered = document.createElement('template');
+            rendered.innerHTML = data.html;
+            const pngFormulas = rendered.content.querySelectorAll('img[data-math-format="png"]');
+            const exported = this.preview.cloneNode(true);
+            const exportedFormulas = exported.querySelectorAll('img[data-math-format="svg"]');
+            if (pngFormulas.length !== exportedFormulas.length) {
+                throw new Error('公式数量不一致');
+            }
+            exportedFormulas.forEach((img, index) => {
+                img.replaceWith(pngFormulas[index]);
+            });
+            return exported.innerHTML;
+        } catch (error) {
+            console.error('公式转换为 PNG 失败:', error);
+            return this.preview.innerHTML;
+        }
+    }
+
     async copyHTML() {
-        const html = this.preview.innerHTML;
+        const html = await this.getExportHTML();
 
         if (!html || html.includes('在左侧输入')) {
             this.showToast('请先输入内容', 'error');
@@ -1651,8 +1807,8 @@ ${this.escapeHTML(source)}</div>
         this.showToast('内容已清空', 'success');
     }
 
-    downloadHTML() {
-        const html = this.preview.innerHTML;
+    async downloadHTML() {
+        const html = await this.getExportHTML();
         if (!html || html.includes('在左侧输入')) {
             this.showToast('请先输入内容', 'error');
             return;
@@ -2226,7 +2382,8 @@ ${html}
             }
 
             this.wechatMediaIdInput.value = data.media_id || '';
-            this.wechatStatus.textContent = `《${data.title || '未命名文章'}》已推送到公众号草稿箱，已上传 ${data.uploaded_image_count || 0} 张正文图片。`;
+            const reusedNote = data.reused_image_count ? `，复用 ${data.reused_image_count} 张已上传的图片` : '';
+            this.wechatStatus.textContent = `《${data.title || '未命名文章'}》已推送到公众号草稿箱，已上传 ${data.uploaded_image_count || 0} 张正文图片${reusedNote}。`;
             this.showToast('公众号草稿推送成功', 'success');
         } catch (error) {
             console.error('公众号草稿推送失败:', error);
@@ -0,0 +1,73 @@
+"""增量渲染与整篇渲染结果一致性测试"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+DOCUMENTS = [
+    # 缩进续行之后换了标记的列表项仍属于同一个列表
+    "- item\n\n    more\n\n+ plus",
+    "1. one\n\n    detail\n\n2) two\n\npara text",
+    # 落单的 $（价格）不能让后文全部并入一个片段
+    "costs $5\n\n# H\n\n- a\n- b\n\npara text",
+    "costs $5\n\ninline $x$ math\n\n> quote",
+    # 转义的 $ 不是公式分隔符
+    "\\$ escaped\n\n$$x$$\n\npara text",
+    # 跨空行的公式、代码围栏和 HTML 块
+    "$a\n\nb$\n\n- item",
+    "$$\na\n\nb\n$$\n\npara text",
+    "```\ncode\n\nmore\n```\n\n`a $ b`\n\ncosts $5",
+    "<div>\n\npara text\n\n</div>\n\n# H",
+    "<div>\n\ncosts $5\n\n</div>\n\n$a\n\nb$",
+    "> quote\n\n> q2\ncont\n\n| a | b |\n|---|---|\n| 1 | 2 |",
+]
+
+
+@pytest.fixture(autouse=True)
+def stub_formula_rendering(monkeypatch):
+    monkeypatch.setattr(app, "render_latex_to_data_url", lambda latex, theme_config=None, image_format="png": "data:image/png;base64,AAAA")
+    app.RENDER_CACHE.clear()
+    app.BLOCK_RENDER_CACHE.clear()
+
+
+@pytest.mark.parametrize("md_text", DOCUMENTS)
+def test_incremental_render_matches_full_render(md_text):
+    assert app.process_markdown(md_text, incremental=True) == app.process_markdown(md_text)
+
+
+def test_list_continuation_stays_in_one_segment():
+    assert app.split_markdown_render_segments("- item\n\n    more\n\n+ plus") == ["- item\n\n    more\n\n+ plus"]
+
+
+def test_lone_dollar_does_not_merge_rest_of_document():
+    assert app.split_markdown_render_segments("costs $5\n\n# H\n\npara text") == ["costs $5", "# H", "para text"]
+
+
+def measure_split_seconds(md_text, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        app.split_markdown_render_segments(md_text)
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+@pytest.mark.parametrize("build_document", [
+    # 松散列表、引用和包在 <div> 中的文章会整篇并成一个片段
+    lambda count: "\n\n".join(f"- item {index} text" for index in range(count)),
+    lambda count: "\n>\n".join(f"> quote {index}" for index in range(count)),
+    lambda count: "<div>\n\n" + "\n\n".join(f"para {index} $x$" for index in range(count)) + "\n\n</div>",
+    # 开头落单的 $ 一直等到文末才配对
+    lambda count: "costs $5\n\n" + "\n\n".join(f"p {index} $a$ and $$b$$" for index in range(count)) + "\n\nend $",
+])
+def test_split_scales_linearly_when_blocks_merge(build_document):
+    small = measure_split_seconds(build_document(500))
+    large = measure_split_seconds(build_document(2000))
+    # 线性约为 4 倍，逐块重扫整个片段时约为 16 倍
+    assert large < small * 8 + 0.05